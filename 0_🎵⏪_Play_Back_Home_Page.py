@@ -3,6 +3,8 @@ import json
 import pandas as pd
 from pathlib import Path
 import process_data
+import src.data.load as load
+import src.data.sessions as sessions
 
 st.set_page_config(page_title="Streaming Analysis", page_icon="🎵", layout="wide")
 
@@ -12,19 +14,20 @@ st.set_page_config(page_title="Streaming Analysis", page_icon="🎵", layout="wi
 
 @st.cache_data
 def load_data(uploaded_file=None):
-    """Load scrobble data from file upload or default path."""
+    """Load scrobble data from file upload or default path, with its session index and fingerprint."""
+    BASE_DIR = Path(__file__).parent  
+    CONFIG_DIR = BASE_DIR / 'config'
+    data_config = json.load(open(Path(CONFIG_DIR / 'data-params.json')))
     if uploaded_file is not None:
         uploaded_file.seek(0)
-        raw_scrobbles = pd.read_csv(uploaded_file)
-        processed_scrobbles = process_data.process_scrobbles(raw_scrobbles)
+        raw_scrobbles = load.read_raw_scrobbles(uploaded_file)
+        processed_scrobbles = process_data.process_scrobbles(raw_scrobbles, timezone = data_config['timezone'])
     else:
-        BASE_DIR = Path(__file__).parent  
         DATA_DIR = BASE_DIR / 'data/processed'
-        CONFIG_DIR = BASE_DIR / 'config'
-        data_config = json.load(open(Path(CONFIG_DIR / 'data-params.json')))
-        processed_scrobbles = pd.read_csv(Path(DATA_DIR / data_config['default_processed_scrobbles_fp']))
-    processed_scrobbles['datetime'] = pd.to_datetime(processed_scrobbles['datetime'])
-    return processed_scrobbles
+        processed_scrobbles = load.read_processed_scrobbles(Path(DATA_DIR / data_config['default_processed_scrobbles_fp']),
+                                                            timezone = data_config['timezone'])
+    session_index = sessions.create_session_index(processed_scrobbles)
+    return processed_scrobbles, session_index, load.scrobbles_fingerprint(processed_scrobbles)
 
 st.title("🎵⏪ Play Back - Music Streaming History Deep Dive")
 st.markdown("No matter which music streaming service you use, Play Back unlocks \
@@ -53,7 +56,7 @@ uploaded_file = st.file_uploader(
 )
 if uploaded_file is not None:
     st.success("✅ File uploaded successfully!")
-    df = load_data(uploaded_file)
+    df, session_index, df_fingerprint = load_data(uploaded_file)
     st.success("✅ Streams processed successfully!")
     st.download_button("Download your processed music streaming data (.csv)", 
                        df.to_csv(index = False), file_name="processed_streams.csv", 
@@ -63,7 +66,7 @@ if uploaded_file is not None:
                        on_click="ignore", icon=":material/csv:")
 else:
     st.info("Using default data. Upload a CSV to use your own.")
-    df = load_data()
+    df, session_index, df_fingerprint = load_data()
 
 # app overview
 st.subheader("👩🏻‍💻 App Overview")
@@ -109,4 +112,6 @@ with st.sidebar:
 
 # Load and store in session state
 st.session_state['df'] = df
+st.session_state['session_index'] = session_index
+st.session_state['df_fingerprint'] = df_fingerprint
 st.session_state['uploaded_file'] = uploaded_file
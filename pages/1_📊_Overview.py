@@ -1,6 +1,8 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
+import src.visualize as visualize
+import src.data.load as load
 
 # ============================================================
 # PAGE CONFIG
@@ -20,6 +22,21 @@ if 'df' not in st.session_state:
 else:
     df = st.session_state['df']
 
+if 'df_fingerprint' not in st.session_state:
+    st.session_state['df_fingerprint'] = load.scrobbles_fingerprint(df)
+df_fingerprint = st.session_state['df_fingerprint']
+
+@st.cache_resource(max_entries = 4, show_spinner = False)
+def load_yearly_rollup(df_fingerprint, _df):
+    """
+    Summarize the scrobbles by year once, for the overview of every year. Cached by 
+    the fingerprint of the scrobbles, and shared instead of copied on each rerun, 
+    so the rollup is read only.
+    """
+    return visualize.create_yearly_rollup(_df)
+
+yearly_rollup = load_yearly_rollup(df_fingerprint, df)
+
 if 'uploaded_file' not in st.session_state:
     uploaded_file = False
 else:
@@ -29,15 +46,15 @@ else:
 # SIDEBAR - YEAR SELECTOR
 # ============================================================
 
-available_years = sorted(df.year.unique(), reverse=True)
+available_years = yearly_rollup['years']
 selected_year = st.sidebar.selectbox(
     "Select Year",
     options=available_years,
     index=0 
 )
 
-# Filter data for selected year
-df_year = df[df['datetime'].dt.year == selected_year].copy()
+# Totals and tables for selected year
+year_totals, year_tables = visualize.year_rollup(yearly_rollup, selected_year)
 
 # ============================================================
 # HEADER
@@ -61,27 +78,27 @@ col1, col2, col3, col4, col5 = st.columns(5)
 
 col1.metric(
     label="Total Streams",
-    value=f"{len(df_year):,}"
+    value=f"{year_totals['streams']:,}"
 )
 
 col2.metric(
     label="Unique Artists",
-    value=f"{df_year['primary_artist'].nunique():,}"
+    value=f"{year_totals['unique_artists']:,}"
 )
 
 col3.metric(
     label="Unique Albums",
-    value=f"{df_year['album'].nunique():,}"
+    value=f"{year_totals['unique_albums_raw']:,}"
 )
 
 col4.metric(
     label="Unique Songs",
-    value=f"{df_year['song_title'].nunique():,}"
+    value=f"{year_totals['unique_songs']:,}"
 )
 
 col5.metric(
     label="New Artists Discovered",
-    value=f"{df_year['first_artist_listen'].sum():,}"
+    value=f"{year_totals['new_artists']:,}"
     # TODO: Ensure first_artist_listen flag is calculated across full history
     # not just within the selected year
 )
@@ -100,13 +117,7 @@ tab_artists, tab_albums, tab_songs = st.tabs(["🎤 Artists", "💿 Albums", "
 
 # --- Top Artists ---
 with tab_artists:
-    top_artists = (
-        df_year.groupby('primary_artist')
-        .agg(streams=('uts', 'count'))
-        .sort_values('streams', ascending=False)
-        .head(N)
-        .reset_index()
-    )
+    top_artists = year_tables['artists'][['primary_artist', 'streams']].head(N).reset_index(drop=True)
 
     col1, col2 = st.columns([1, 2])
 
@@ -117,7 +128,7 @@ with tab_artists:
             width='stretch'
         )
 
-    with col2:
+    def top_artists_chart():
         fig = px.bar(
             top_artists,
             x='streams',
@@ -133,17 +144,15 @@ with tab_artists:
             showlegend=False,
             coloraxis_showscale=False
         )
+        return fig
+
+    with col2:
+        fig = visualize.cached_figure(top_artists_chart, df_fingerprint, 'top_artists', year=selected_year)
         st.plotly_chart(fig, width='stretch')
 
 # --- Top Albums ---
 with tab_albums:
-    top_albums = (
-        df_year.groupby(['album_final', 'primary_artist'])
-        .agg(streams=('uts', 'count'))
-        .sort_values('streams', ascending=False)
-        .head(N)
-        .reset_index()
-    )
+    top_albums = year_tables['albums'].head(N).reset_index(drop=True)
 
     col1, col2 = st.columns([1, 2])
 
@@ -158,8 +167,8 @@ with tab_albums:
             width='stretch'
         )
 
-    with col2:
-        top_albums['label'] = top_albums['album_final'] + ' - ' + top_albums['primary_artist']
+    def top_albums_chart():
+        top_albums['label'] = top_albums['album_final'].astype(str) + ' - ' + top_albums['primary_artist'].astype(str)
         fig = px.bar(
             top_albums,
             x='streams',
@@ -175,17 +184,15 @@ with tab_albums:
             showlegend=False,
             coloraxis_showscale=False
         )
+        return fig
+
+    with col2:
+        fig = visualize.cached_figure(top_albums_chart, df_fingerprint, 'top_albums', year=selected_year)
         st.plotly_chart(fig, width='stretch')
 
 # --- Top Songs ---
 with tab_songs:
-    top_songs = (
-        df_year.groupby(['song_title', 'primary_artist'])
-        .agg(streams=('uts', 'count'))
-        .sort_values('streams', ascending=False)
-        .head(N)
-        .reset_index()
-    )
+    top_songs = year_tables['songs'].head(N).reset_index(drop=True)
 
     col1, col2 = st.columns([1, 2])
 
@@ -200,8 +207,8 @@ with tab_songs:
             width='stretch'
         )
 
-    with col2:
-        top_songs['label'] = top_songs['song_title'] + ' - ' + top_songs['primary_artist']
+    def top_songs_chart():
+        top_songs['label'] = top_songs['song_title'].astype(str) + ' - ' + top_songs['primary_artist'].astype(str)
         fig = px.bar(
             top_songs,
             x='streams',
@@ -217,6 +224,10 @@ with tab_songs:
             showlegend=False,
             coloraxis_showscale=False
         )
+        return fig
+
+    with col2:
+        fig = visualize.cached_figure(top_songs_chart, df_fingerprint, 'top_songs', year=selected_year)
         st.plotly_chart(fig, width='stretch')
 
 st.divider()
@@ -230,12 +241,8 @@ st.subheader("Listening Behavior")
 col1, col2 = st.columns(2)
 
 # --- Streams by Day of Week ---
-with col1:
-    dow_counts = (
-        df_year.groupby('weekday')
-        .agg(streams=('song_title', 'count'))
-        .reset_index()
-    )
+def day_of_week_chart():
+    dow_counts = year_tables['weekday'].copy()
 
     # e.g. 'Monday', 'Tuesday', etc. in preprocessing
     day_order = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
@@ -252,15 +259,15 @@ with col1:
         color_continuous_scale='Greens'
     )
     fig.update_layout(coloraxis_showscale=False)
+    return fig
+
+with col1:
+    fig = visualize.cached_figure(day_of_week_chart, df_fingerprint, 'day_of_week', year=selected_year)
     st.plotly_chart(fig, width='stretch')
 
 # --- Streams by Time of Day ---
-with col2:
-    tod_counts = (
-        df_year.groupby('time_of_day')
-        .agg(streams=('song_title', 'count'))
-        .reset_index()
-    )
+def time_of_day_chart():
+    tod_counts = year_tables['time_of_day'].copy()
 
     # TODO: Ensure time_of_day is stored as ordered categorical in preprocessing
     tod_order = ['morning', 'afternoon', 'evening', 'night', 'late  night']
@@ -277,6 +284,10 @@ with col2:
         color_continuous_scale='Blues'
     )
     fig.update_layout(coloraxis_showscale=False)
+    return fig
+
+with col2:
+    fig = visualize.cached_figure(time_of_day_chart, df_fingerprint, 'time_of_day', year=selected_year)
     st.plotly_chart(fig, width='stretch')
 
 st.divider()
@@ -290,17 +301,11 @@ st.subheader("Discovery Highlights")
 col1, col2 = st.columns(2)
 
 # --- New Artist Discoveries by Month ---
-with col1:
-    new_artists = df_year[df_year['first_artist_listen'] == True].copy()
-    new_artists['month'] = new_artists['datetime'].dt.month_name()
+def monthly_new_artists_chart():
     month_order = ['January', 'February', 'March', 'April', 'May', 'June',
                    'July', 'August', 'September', 'October', 'November', 'December']
 
-    monthly_discoveries = (
-        new_artists.groupby('month')
-        .agg(new_artists=('primary_artist', 'count'))
-        .reset_index()
-    )
+    monthly_discoveries = year_tables['monthly_new_artists'].copy()
     monthly_discoveries['month'] = pd.Categorical(
         monthly_discoveries['month'],
         categories=month_order,
@@ -318,17 +323,21 @@ with col1:
         color_continuous_scale='Purples'
     )
     fig.update_layout(coloraxis_showscale=False)
+    return fig
+
+with col1:
+    fig = visualize.cached_figure(monthly_new_artists_chart, df_fingerprint, 'monthly_new_artists', year=selected_year)
     st.plotly_chart(fig, width='stretch')
 
 # --- Top Discovered Artists ---
 with col2:
-    new_artists_streams = df_year.loc[df_year.primary_artist.isin(new_artists.primary_artist.unique())]
+    # artists with a first listen this year, by this year's streams
+    discovered_artists = year_tables['artists'][year_tables['artists']['first_listens'] > 0]
     top_discovered = (
-        new_artists_streams.groupby('primary_artist')
-        .agg(streams=('song_title', 'count'))
-        .sort_values('streams', ascending=False)
+        discovered_artists[['primary_artist', 'plays']]
+        .rename(columns={'plays': 'streams'})
         .head(10)
-        .reset_index()
+        .reset_index(drop=True)
     )
 
     st.markdown(f"**Top Newly Discovered Artists in {selected_year}**")
@@ -347,17 +356,11 @@ st.divider()
 col1, col2 = st.columns(2)
 
 # --- New Album Discoveries by Month ---
-with col1:
-    new_albums = df_year[df_year['first_album_listen'] == True].copy()
-    new_albums['month'] = new_albums['datetime'].dt.month_name()
+def monthly_new_albums_chart():
     month_order = ['January', 'February', 'March', 'April', 'May', 'June',
                    'July', 'August', 'September', 'October', 'November', 'December']
 
-    monthly_discoveries = (
-        new_albums.groupby('month')
-        .agg(new_albums=('album_final', 'count'))
-        .reset_index()
-    )
+    monthly_discoveries = year_tables['monthly_new_albums'].copy()
     monthly_discoveries['month'] = pd.Categorical(
         monthly_discoveries['month'],
         categories=month_order,
@@ -375,18 +378,17 @@ with col1:
         color_continuous_scale='Purples'
     )
     fig.update_layout(coloraxis_showscale=False)
+    return fig
+
+with col1:
+    fig = visualize.cached_figure(monthly_new_albums_chart, df_fingerprint, 'monthly_new_albums', year=selected_year)
     st.plotly_chart(fig, width='stretch')
 
 # --- Top Discovered Albums ---
 with col2:
-    new_albums_streams = df_year.loc[df_year.album_final.isin(new_albums.album_final.unique())]
-    top_discovered = (
-        new_albums_streams.groupby('album_final')
-        .agg(streams=('song_title', 'count'))
-        .sort_values('streams', ascending=False)
-        .head(10)
-        .reset_index()
-    )
+    # albums with a first listen this year, by this year's streams
+    discovered_albums = year_tables['discovered_albums'][year_tables['discovered_albums']['first_listens'] > 0]
+    top_discovered = discovered_albums[['album_final', 'streams']].head(10).reset_index(drop=True)
 
     st.markdown(f"**Top Newly Discovered Albums in {selected_year}**")
     st.markdown(f"*Albums you listened to for the first time in {selected_year}, ranked by total streams.*")
@@ -408,19 +410,6 @@ st.divider()
 if len(available_years) > 1:
     st.subheader("Year-over-Year Comparison")
 
-    # Compare key metrics across years
-    yoy_stats = (
-        df.groupby(df['datetime'].dt.year)
-        .agg(
-            total_streams=('song_title', 'count'),
-            unique_artists=('primary_artist', 'nunique'),
-            unique_albums=('album_final', 'nunique'),
-            unique_songs=('song_title', 'nunique')
-        )
-        .reset_index()
-        .rename(columns={'datetime': 'year'})
-    )
-
     # Metric selector
     yoy_metric = st.selectbox(
         "Compare metric across years:",
@@ -438,16 +427,25 @@ if len(available_years) > 1:
         }[x]
     )
 
-    fig = px.bar(
-        yoy_stats,
-        x='year',
-        y=yoy_metric,
-        labels={'year': 'Year', yoy_metric: yoy_metric.replace('_', ' ').title()},
-        title=f'{yoy_metric.replace("_", " ").title()} by Year',
-        color='year',
-        color_continuous_scale='purpor'
-    )
-    fig.update_layout(coloraxis_showscale=False)
+    def yoy_chart():
+        # Compare key metrics across years
+        yoy_stats = yearly_rollup['totals'][
+            ['total_streams', 'unique_artists', 'unique_albums', 'unique_songs']
+        ].reset_index()
+
+        fig = px.bar(
+            yoy_stats,
+            x='year',
+            y=yoy_metric,
+            labels={'year': 'Year', yoy_metric: yoy_metric.replace('_', ' ').title()},
+            title=f'{yoy_metric.replace("_", " ").title()} by Year',
+            color='year',
+            color_continuous_scale='purpor'
+        )
+        fig.update_layout(coloraxis_showscale=False)
+        return fig
+
+    fig = visualize.cached_figure(yoy_chart, df_fingerprint, 'year_over_year', metric=yoy_metric)
     st.plotly_chart(fig, width='stretch')
 
     st.divider()
@@ -1,9 +1,12 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 from pathlib import Path
 import utils
 import src.visualize as visualize  
+import src.data.sessions as sessions
+import src.data.load as load
 import plotly.graph_objects as go
 
 # ============================================================
@@ -26,6 +29,17 @@ if 'df' not in st.session_state:
     st.stop()  # Stops the page from rendering further
 else:
     df = st.session_state['df']
+    session_index = st.session_state['session_index']
+
+if 'df_fingerprint' not in st.session_state:
+    st.session_state['df_fingerprint'] = load.scrobbles_fingerprint(df)
+
+@st.cache_data(max_entries = 4, show_spinner = False)
+def load_daily_rollup(df_fingerprint, _df):
+    """Summarize the scrobbles by day once, for every calendar of every year."""
+    return visualize.create_daily_rollup(_df)
+
+daily_rollup = load_daily_rollup(st.session_state['df_fingerprint'], df)
 
 if 'uploaded_file' not in st.session_state:
     uploaded_file = False
@@ -62,28 +76,23 @@ full_year, q1, q2, q3, q4 = st.tabs(quarter_labels)
 
 with full_year:
     # yearly calendar
-    processed_scrobbles_filt, fig = visualize.create_scrobbles_heatmap(df, year)
+    fig = visualize.cached_figure(lambda: visualize.create_scrobbles_heatmap(daily_rollup, year), 
+                                  st.session_state['df_fingerprint'], 'heatmap', year = year, quarter = 0)
     st.plotly_chart(fig, width='stretch')
-    first_session_id = processed_scrobbles_filt.session_id.min()
-    last_session_id = processed_scrobbles_filt.session_id.max()
-    first_session = processed_scrobbles_filt.loc[
-        processed_scrobbles_filt.session_id == first_session_id
-    ][['artist', 'album_final', 'song_title']].reset_index(drop = True).rename(
-        columns = {
-            'artist':'Artist',
-            'album_final': 'Album',
-            'song_title': 'Song Title'
-        }
-    )
-    last_session = processed_scrobbles_filt.loc[
-        processed_scrobbles_filt.session_id == last_session_id
-    ][['artist', 'album_final', 'song_title']].reset_index(drop = True).rename(
-        columns = {
-            'artist':'Artist',
-            'album_final': 'Album',
-            'song_title': 'Song Title'
-        }
-    )
+    session_cols = ['artist', 'album_final', 'song_title']
+    session_col_names = {
+        'artist':'Artist',
+        'album_final': 'Album',
+        'song_title': 'Song Title'
+    }
+    # scrobbles are sorted, so the year's first and last sessions are at its ends
+    year_rows = np.flatnonzero(df['year'].to_numpy() == year)
+    first_session = sessions.get_session(
+        df, session_index, df['session_id'].iat[year_rows[0]]
+    )[session_cols].reset_index(drop = True).rename(columns = session_col_names)
+    last_session = sessions.get_session(
+        df, session_index, df['session_id'].iat[year_rows[-1]]
+    )[session_cols].reset_index(drop = True).rename(columns = session_col_names)
     col1, col2 = st.columns(2)
     with col1:
         st.subheader(f'First Listening Session of {year}')
@@ -93,13 +102,13 @@ with full_year:
         col2.dataframe(last_session, hide_index = True)
 
 with q1:
-    utils.render_calendar(df, year, 1)
+    utils.render_calendar(df, daily_rollup, year, 1, st.session_state['df_fingerprint'])
 with q2:
-    utils.render_calendar(df, year, 2)
+    utils.render_calendar(df, daily_rollup, year, 2, st.session_state['df_fingerprint'])
 with q3:
-    utils.render_calendar(df, year, 3)
+    utils.render_calendar(df, daily_rollup, year, 3, st.session_state['df_fingerprint'])
 with q4:
-    utils.render_calendar(df, year, 4)
+    utils.render_calendar(df, daily_rollup, year, 4, st.session_state['df_fingerprint'])
 st.divider()
 st.subheader("Check out the other pages:")
 st.page_link("pages/1_📊_Overview.py", label='Overview', icon="📊")
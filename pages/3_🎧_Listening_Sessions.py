@@ -3,6 +3,9 @@ import json
 import pandas as pd
 from pathlib import Path
 import utils
+import src.data.load as load
+import src.data.sessions as sessions
+import src.models.clustering as clustering
 # ============================================================
 # PAGE CONFIG
 # ============================================================
@@ -26,9 +29,36 @@ st.subheader("🔎 My (user jqlistens') 2025 Listening Session Analysis")
 DATA_DIR = BASE_DIR / 'data/processed'
 CONFIG_DIR = BASE_DIR / 'config'
 data_config = json.load(open(Path(CONFIG_DIR / 'data-params.json')))
-session_stats_2025 = pd.read_csv(Path(DATA_DIR / data_config['default_session_stats_fp']))
-df = pd.read_csv(Path(DATA_DIR / data_config['default_processed_scrobbles_fp']))
-processed_scrobbles = df.loc[df.year == 2025].copy()
+MODEL_DIR = BASE_DIR / data_config['model_loc']
+
+@st.cache_data
+def load_reference_clusters(session_stats_fp, model_dir):
+    """Load my 2025 session stats, clustered by the saved reference model."""
+    session_stats = pd.read_csv(session_stats_fp)
+    model, _ = clustering.get_clustering_model(session_stats, 4, model_dir)
+    session_stats['cluster'] = clustering.predict_clusters(model, session_stats)
+    return session_stats
+
+@st.cache_data
+def load_reference_examples(session_stats_fp, model_dir):
+    """Find the 2 sessions nearest each cluster's centroid in my 2025 session stats."""
+    session_stats = load_reference_clusters(session_stats_fp, model_dir)
+    neighbors_index = clustering.get_neighbors_index(session_stats, model_dir)
+    return clustering.representative_sessions(neighbors_index, session_stats.cluster, n_sessions = 2)
+
+session_stats_2025 = load_reference_clusters(Path(DATA_DIR / data_config['default_session_stats_fp']), MODEL_DIR)
+example_session_ids = load_reference_examples(Path(DATA_DIR / data_config['default_session_stats_fp']), MODEL_DIR)
+
+@st.cache_data
+def load_sessions(processed_scrobbles_fp, timezone):
+    """Load processed scrobbles with their session index and session summaries."""
+    processed_scrobbles = load.read_processed_scrobbles(processed_scrobbles_fp, timezone = timezone)
+    session_index = sessions.create_session_index(processed_scrobbles)
+    session_summaries = clustering.create_session_summaries(processed_scrobbles, session_index)
+    return processed_scrobbles, session_index, session_summaries
+
+df, session_index, session_summaries = load_sessions(Path(DATA_DIR / data_config['default_processed_scrobbles_fp']),
+                                                     data_config['timezone'])
 
 session_tab_labels = ["🧘 Weekend Wind Down - Cluster 1",
                       "💡 New Discovery - Cluster 2", 
@@ -36,27 +66,15 @@ session_tab_labels = ["🧘 Weekend Wind Down - Cluster 1",
                       "🌙 Late Night Faves - Cluster 4"
                       ]
 
+# examples are the sessions nearest each cluster's centroid
 example_labels = {
-    0:['Go-to Artists',
-       'My Favorite Tracks'],
-    1:['Catching Up on New Music Friday',
-       'New Discoveries Spanning Eras and Genres'],
-    2:['1st Listen of the 2026 AOTY - DeBÍ TiRAR MáS FOToS by Bad Bunny',
-       'Playlist Sesh - West Coast Rap Exploration'],
-    3:['R&B Hits Old and New',
-       'Saturday Night R&B']
-}
-
-example_session_ids = {
-    0:[5243,5488],
-    1:[5032,5361],
-    2:[4970,5111],
-    3:[5503,4964]
+    cluster:['Most Typical Session', 'Runner-Up Typical Session']
+    for cluster in example_session_ids
 }
 
 example_insights = {
     cluster:[utils.create_example_insight(cluster, index, example_labels, 
-                                 example_session_ids, processed_scrobbles) 
+                                 example_session_ids, df, session_index, session_summaries) 
             for index in range(2)]
     for cluster in example_session_ids
 }
@@ -86,6 +104,9 @@ for tab in tabs:
     example1 = example_insights[cluster][0]
     example2 = example_insights[cluster][1]
     with tab:
+        n_cluster_sessions = (session_stats_2025.cluster == cluster).sum()
+        st.caption(f"{n_cluster_sessions:,} of my {len(session_stats_2025):,} listening sessions in 2025 \
+                   ({n_cluster_sessions / len(session_stats_2025):.0%})")
         st.markdown(cluster_descriptions[cluster])
         utils.render_cluster_tab(example1, 1)
         st.divider()
@@ -1,15 +1,20 @@
 import streamlit as st
 import pandas as pd
+import plotly.express as px
 from pathlib import Path
 import os 
-import sys
+import json
 import utils
-import perform_clustering
+import src.visualize as visualize
+# imported from src like the other entry points, so that saved models load everywhere
+import src.models.clustering as clustering 
+import src.data.sessions as sessions
+import src.data.load as load
 
 project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-sys.path.append(os.path.join(project_dir, 'src'))
 
-import models.clustering as clustering 
+data_config = json.load(open(Path(project_dir) / 'config/data-params.json'))
+MODEL_DIR = Path(project_dir) / data_config['model_loc']
 
 # ============================================================
 # PAGE CONFIG
@@ -26,6 +31,9 @@ if 'df' not in st.session_state:
 else:
     df = st.session_state['df']
 
+if 'df_fingerprint' not in st.session_state:
+    st.session_state['df_fingerprint'] = load.scrobbles_fingerprint(df)
+
 if 'uploaded_file' not in st.session_state:
     uploaded_file = False
 else:
@@ -33,7 +41,8 @@ else:
 
 st.session_state['ready_to_configure'] = True
 session_state_variables = ['session_stats', 'model_configured', 'model_ready',
-                           'train_model', 'year', 'model_trained', 'n_clusters', 'processed_scrobbles']
+                           'train_model', 'year', 'model_trained', 'n_clusters', 'processed_scrobbles',
+                           'session_summaries', 'year_session_stats', 'feature_matrix', 'neighbors_index']
 
 def clear():
     '''
@@ -59,6 +68,43 @@ def initialize_session_state(vars):
         if var not in st.session_state:
             st.session_state[var] = False
 
+@st.cache_resource(max_entries = 16, show_spinner = False)
+def load_year_sessions(df_fingerprint, year, threshold_minutes, _df):
+    """
+    Extract the listening sessions of one year, with their stats and clustering features. 
+    Cached by the fingerprint of the scrobbles instead of hashing them, and shared 
+    by every number of clusters trained on the year. The cached objects are shared 
+    instead of copied on each rerun, so they are read only.
+    """
+    processed_scrobbles = _df.loc[_df['year'] == year].copy()
+    threshold_sessions, threshold_stats = sessions.sweep_session_thresholds(processed_scrobbles)
+    if threshold_minutes != 10:
+        # sessions were extracted with a 10 minute break when processing
+        year_sessions, session_ids = threshold_sessions[threshold_minutes * 60]
+        processed_scrobbles = sessions.add_session_columns(processed_scrobbles, year_sessions, session_ids)
+    session_index = sessions.create_session_index(processed_scrobbles)
+    session_summaries = clustering.create_session_summaries(processed_scrobbles, session_index)
+    year_session_stats = sessions.create_session_stats(processed_scrobbles)
+    X_transformed, _ = clustering.prepare_data(year_session_stats)
+    neighbors_index = clustering.create_neighbors_index(X_transformed, year_session_stats.session_id)
+    return (processed_scrobbles, threshold_stats, session_index, session_summaries, 
+            year_session_stats, X_transformed, neighbors_index)
+
+@st.cache_resource(max_entries = 64, show_spinner = False)
+def load_year_clusters(df_fingerprint, year, threshold_minutes, n_clusters, _year_session_stats):
+    """
+    Cluster the listening sessions of one year with the model saved in MODEL_DIR for 
+    their stats and number of clusters, fitting and saving one if there is none. 
+    Cached like load_year_sessions.
+    """
+    _, cluster_predictions = clustering.run_clustering_model(_year_session_stats, n_clusters, MODEL_DIR)
+    return cluster_predictions
+
+@st.cache_data(max_entries = 64, show_spinner = False)
+def load_cluster_histograms(df_fingerprint, year, threshold_minutes, n_clusters, _session_stats):
+    """Bin every analyzed feature per cluster once per trained model, cached like load_year_clusters."""
+    return clustering.create_cluster_histograms(_session_stats, clustering.DISTRIBUTION_FEATURES)
+
 def clear_train_button():
     st.session_state['model_trained'] = False
     st.session_state['model_ready'] = False
@@ -85,27 +131,59 @@ if st.session_state['ready_to_configure']:
         available_full_years = sorted(month_counts[month_counts.month == 12].index.values, reverse=True)
         year = st.radio('Choose the year of streams for training', available_full_years)
         st.session_state['year'] = year 
+        threshold_minutes = st.select_slider("Choose the longest break (minutes) within a listening session",
+                                             options = [t // 60 for t in sessions.SESSION_THRESHOLDS], 
+                                             value = 10)
+        st.session_state['threshold_minutes'] = threshold_minutes
         if st.form_submit_button("Configure model") or st.session_state['train_model']:
-            processed_scrobbles = df.loc[df['year'] == year].copy()
+            (processed_scrobbles, threshold_stats, session_index, session_summaries, 
+             year_session_stats, X_transformed, neighbors_index) = load_year_sessions(
+                st.session_state['df_fingerprint'], year, threshold_minutes, df
+            )
             st.session_state['processed_scrobbles'] = processed_scrobbles
+            st.session_state['processed_scrobbles_session_index'] = session_index
+            st.session_state['session_summaries'] = session_summaries
+            st.session_state['year_session_stats'] = year_session_stats
+            st.session_state['feature_matrix'] = X_transformed
+            st.session_state['neighbors_index'] = neighbors_index
             st.markdown('**Preview Input Data Before Training**')
             st.dataframe(
                 processed_scrobbles[['date', 'song_title', 'album_final', 'primary_artist']].head(10),
                 hide_index = True
             )
+            st.markdown('**Listening Sessions by Longest Break**')
+            threshold_stats = threshold_stats.copy()
+            threshold_stats.insert(0, 'longest break (minutes)', threshold_stats.pop('threshold') // 60)
+            st.dataframe(threshold_stats, hide_index = True)
             st.session_state['model_configured'] = True
             st.session_state['model_ready'] = True
             st.session_state['train_model'] = False
 
 if st.session_state['model_ready']:
+    with st.expander("📈 Not sure how many clusters to choose?"):
+        st.markdown("Compare models with 2 to 6 clusters. Inertia (how far sessions are from their \
+                    cluster's center) always drops as clusters are added, so look for the elbow where it \
+                    stops dropping quickly. Higher silhouette scores mean more distinct clusters.")
+        if st.button("Compare numbers of clusters", icon = ':material/insights:'):
+            sweep = clustering.sweep_n_clusters(st.session_state['year_session_stats'], model_dir = MODEL_DIR)
+            col1, col2 = st.columns(2)
+            col1.plotly_chart(px.line(sweep, x = 'n_clusters', y = 'inertia', markers = True,
+                                      title = 'Inertia (Elbow Method)'), width = 'stretch')
+            col2.plotly_chart(px.line(sweep, x = 'n_clusters', y = 'silhouette', markers = True,
+                                      title = 'Silhouette Score'), width = 'stretch')
+            st.info(f"Suggested number of clusters: {clustering.suggest_n_clusters(sweep)}", 
+                    icon = ':material/lightbulb:')
     with st.form("start_train_model"):
         if st.form_submit_button('Train your K-Means Clustering Model', type = 'primary', 
                                  icon = ':material/model_training:', on_click = clear_train_button):
              st.session_state['train_model'] = True
 
         if st.session_state['train_model']:
-            session_stats = perform_clustering.run_clustering(st.session_state['processed_scrobbles'],
-                                                              st.session_state['n_clusters'])
+            cluster_predictions = load_year_clusters(st.session_state['df_fingerprint'], st.session_state['year'],
+                                                     st.session_state['threshold_minutes'], 
+                                                     st.session_state['n_clusters'], 
+                                                     st.session_state['year_session_stats'])
+            session_stats = st.session_state['year_session_stats'].assign(cluster = cluster_predictions)
             st.session_state['model_trained'] = True
             st.session_state['session_stats'] = session_stats
             model_trained = True
@@ -131,10 +209,7 @@ if st.session_state['model_ready']:
 if st.session_state['model_trained']:
     st.subheader("Analyze the Clustering Results")
     st.markdown("Use the menu below and select a feature to analyze your clusters over.")
-    features = ['first_listen_ratio', 'artist_diversity', 
-                'album_diversity','song_diversity', 'weekday', 'season',
-                'stream_count', 'song_title_nunique', 'primary_artist_nunique', 
-                'album_nunique', 'session_length', ]
+    features = clustering.DISTRIBUTION_FEATURES
     feat_captions = ['Proportion of streams that was a first listen/new discovery',
                      'Proportion of streams that were of unique artists', 
                      'Proportion of streams that were of unique albums', 
@@ -145,7 +220,18 @@ if st.session_state['model_trained']:
                      ]
     selected_feature = st.radio("Choose a feature", options = features, horizontal = True,
              captions = feat_captions)
-    hist = clustering.inter_cluster_distributions(selected_feature, st.session_state['session_stats'])
+    # clusters depend on the year, longest break, and number of clusters trained on
+    cluster_histograms = load_cluster_histograms(st.session_state['df_fingerprint'], st.session_state['year'],
+                                                 st.session_state['threshold_minutes'], 
+                                                 st.session_state['n_clusters'], 
+                                                 st.session_state['session_stats'])
+    hist = visualize.cached_figure(
+        lambda: clustering.inter_cluster_distributions(selected_feature, st.session_state['session_stats'], 
+                                                       cluster_histograms),
+        st.session_state['df_fingerprint'], 'cluster_distribution', year = st.session_state['year'], 
+        threshold_minutes = st.session_state['threshold_minutes'], n_clusters = st.session_state['n_clusters'], 
+        feature = selected_feature
+    )
     st.plotly_chart(hist, width = 'stretch')
     session_cluster_aggs = st.session_state['session_stats'].groupby('cluster').agg({
         'stream_count': ['count','median','mean'],
@@ -170,10 +256,25 @@ if st.session_state['model_trained']:
         with tab: 
             try:
                 utils.cluster_example_tab(cluster, st.session_state['session_stats'],
-                                        st.session_state['processed_scrobbles'])
+                                        st.session_state['processed_scrobbles'],
+                                        st.session_state['processed_scrobbles_session_index'],
+                                        st.session_state['session_summaries'],
+                                        st.session_state['neighbors_index'])
             except:
                 pass
         cluster += 1
+    st.subheader('🏆 Your Standout Listening Sessions')
+    summary_cols = utils.SESSION_SUMMARY_COLUMNS
+    session_summaries = st.session_state['session_summaries']
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown('**Longest Sessions**')
+        st.dataframe(session_summaries.nlargest(5, 'duration_seconds')[list(summary_cols)]
+                     .rename(columns = summary_cols), hide_index = True)
+    with col2:
+        st.markdown('**Most Diverse Sessions**')
+        st.dataframe(session_summaries.sort_values(['primary_artist', 'stream_count'], ascending = False)
+                     .head(5)[list(summary_cols)].rename(columns = summary_cols), hide_index = True)
 
 if st.session_state['model_trained']:
     st.divider()
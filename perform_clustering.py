@@ -5,20 +5,26 @@ import json
 from datetime import datetime
 from pathlib import Path
 
+import src.data.load as load
 import src.models.clustering as clustering
 import src.data.sessions as sessions 
 
-def run_clustering(processed_scrobbles, n_clusters = 4):
+def run_clustering(processed_scrobbles, n_clusters = 4, model_dir = None, engine = 'kmeans'):
     """
     run all scripts necessary to run the clusters 
     Args:
         processed_scrobbles (pandas.DataFrame): dataframe of processed scrobbles 
         n_clusters (int, default 4): number of clusters for model to create 
+        model_dir (str or pathlib.Path, default None): directory of saved models to
+            reuse and save to
+        engine (str, default 'kmeans'): training engine, 'kmeans' or 'minibatch' to 
+            train on batches of sessions with bounded memory
     Returns:
         pandas.DataFrame: dataframe with insights for each listening session
     """
     session_stats = sessions.create_session_stats(processed_scrobbles)
-    session_stats_transformed, cluster_predictions = clustering.run_clustering_model(session_stats, n_clusters)
+    session_stats_transformed, cluster_predictions = clustering.run_clustering_model(session_stats, n_clusters,
+                                                                                     model_dir, engine)
     session_stats['cluster'] = cluster_predictions
     return session_stats
 
@@ -51,12 +57,13 @@ def main(targets):
         session_stats_filename = f'{date_str}_session_stats.csv'
         session_stats_fp = Path(OUT_DATA_DIR / session_stats_filename)
         data_config['test_session_stats_fp'] = session_stats_filename
-    processed_scrobbles = pd.read_csv(processed_scrobbles_fp)
-    if len(targets) == 2:
-        n_clusters = int(targets[-1]) 
-    else: 
-        n_clusters = 4
-    session_stats = run_clustering(processed_scrobbles, session_stats_fp, n_clusters)
+    processed_scrobbles = load.read_processed_scrobbles(processed_scrobbles_fp, timezone = data_config['timezone'])
+    n_clusters = next((int(target) for target in targets if target.isdigit()), 4)
+    engine = 'minibatch' if 'minibatch' in targets else 'kmeans'
+    if 'benchmark' in targets:
+        print(clustering.benchmark_engines(sessions.create_session_stats(processed_scrobbles), n_clusters))
+    model_dir = BASE_DIR / data_config['model_loc']
+    session_stats = run_clustering(processed_scrobbles, n_clusters, model_dir, engine)
     session_stats.to_csv(session_stats_fp, index = False)
     with open(str(BASE_DIR) + '/config/data-params.json', 'w') as file:
         file.write(str(data_config).replace("'", '"'))
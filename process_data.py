@@ -2,34 +2,205 @@ import sys
 import pandas as pd
 import os
 import json
+import logging
+import tempfile
 from datetime import datetime
 from pathlib import Path
 
+import src.data.load as load
 import src.data.preprocess as preprocess
 import src.data.temporal as temporal
 import src.data.sessions as sessions 
 
-def process_scrobbles(scrobbles):
+logger = logging.getLogger(__name__)
+
+def process_scrobbles(scrobbles, timezone = 'America/Los_Angeles'):
     """
     run all scripts to process raw scrobbles data
     Args:
         processed_scrobbles (pandas.DataFrame): dataframe of raw scrobbles 
+        timezone (str or list, default 'America/Los_Angeles'): timezone name, or
+            list of (from uts, timezone name) periods for users who moved
     Returns:
         pandas.DataFrame: dataframe with completely processed scrobbles and
             additional features 
     """
-    processed_scrobbles = preprocess.preprocess_scrobbles_df(scrobbles)
-    processed_scrobbles = temporal.process_temporal(processed_scrobbles)
-    processed_scrobbles = sessions.process_sessions(processed_scrobbles)
+    processed_scrobbles, _ = process_new_scrobbles(scrobbles, timezone = timezone)
     return processed_scrobbles
 
+def process_new_scrobbles(scrobbles, seen_listens = None, timezone = 'America/Los_Angeles'):
+    """
+    process raw scrobbles that come after the scrobbles of earlier runs, so 
+    that first listens are only flagged for artists, songs, and albums not 
+    listened to before
+    Args:
+        processed_scrobbles (pandas.DataFrame): dataframe of raw scrobbles 
+        seen_listens (dict, default None): first listens and album counts of 
+            earlier runs (see temporal.read_seen_listens). if None, no earlier listens
+        timezone (str or list, default 'America/Los_Angeles'): timezone name, or
+            list of (from uts, timezone name) periods for users who moved
+    Returns:
+        tuple: (pandas.DataFrame with completely processed scrobbles and additional
+            features, dict of first listens up to and including these scrobbles)
+    """
+    if seen_listens is None:
+        seen_listens = temporal.new_seen_listens()
+    if isinstance(scrobbles, pd.DataFrame):
+        scrobbles_df = scrobbles.copy()
+    else:
+        scrobbles_df = load.read_raw_scrobbles(scrobbles)
+    processed_scrobbles, artist_credits, album_counts, tracks_with_unique_albums = \
+        preprocess.preprocess_new_scrobbles(scrobbles_df, seen_listens['artist_credits'],
+                                            seen_listens['album_counts'])
+    seen_listens = resolve_seen_albums(seen_listens, artist_credits, album_counts, 
+                                       tracks_with_unique_albums)
+    processed_scrobbles, seen_listens = temporal.process_temporal(processed_scrobbles, timezone, seen_listens)
+    seen_listens = add_album_tracks(seen_listens, processed_scrobbles)
+    processed_scrobbles = sessions.process_sessions(processed_scrobbles)
+    processed_scrobbles, bytes_saved = load.compact(processed_scrobbles)
+    logger.info('compacted processed scrobbles, %.1f MB saved', bytes_saved / 1e6)
+    return processed_scrobbles, seen_listens
+
+def resolve_seen_albums(seen_listens, artist_credits, album_counts, tracks_with_unique_albums):
+    """
+    key the albums listened to in earlier runs by the final album names chosen
+    from the album counts so far, since counting later scrobbles can change 
+    the final album name of an earlier track
+    Args:
+        seen_listens (dict): state from temporal.new_seen_listens. not modified
+        artist_credits (pandas.DataFrame): artist credit dimension of the scrobbles so far
+        album_counts (pandas.DataFrame): album counts of the scrobbles so far
+        tracks_with_unique_albums (pandas.DataFrame): final album names chosen 
+            from album_counts
+    Returns:
+        dict: state like seen_listens with re-keyed 'album' listens and the 
+            given artist credits and album counts
+    """
+    seen_listens = dict(seen_listens, artist_credits = artist_credits, album_counts = album_counts)
+    album_tracks = seen_listens['album_tracks'].copy()
+    if len(album_tracks) == 0:
+        return seen_listens
+    credit_ids = album_tracks['artist_credit_id'].to_numpy()
+    album_tracks['artist_key'] = artist_credits['artist_key'].values[credit_ids]
+    album_tracks = preprocess.apply_final_album_names(album_tracks, album_counts, tracks_with_unique_albums)
+    album_tracks = preprocess.add_artist_columns(album_tracks, artist_credits)
+    album_keys = temporal.first_listen_keys(album_tracks)['album']
+    seen_listens['album'] = (album_tracks['first_uts'].set_axis(pd.Index(album_keys, name = 'key'))
+                             .groupby(level = 'key', sort = False).min())
+    return seen_listens
+
+def add_album_tracks(seen_listens, processed_scrobbles):
+    """
+    add the (artist credit, track) pairs first listened to in processed 
+    scrobbles to the state, so their albums can be re-keyed by later runs
+    Args:
+        seen_listens (dict): state from temporal.new_seen_listens. not modified
+        processed_scrobbles (pandas.DataFrame): sorted scrobbles with 
+            'artist_credit_id' and 'song_title'
+    Returns:
+        dict: state like seen_listens with the new tracks in 'album_tracks'
+    """
+    album_tracks = seen_listens['album_tracks']
+    new_tracks = (processed_scrobbles[['artist_credit_id', 'song_title', 'uts']]
+                  .rename(columns = {'song_title':'track', 'uts':'first_uts'})
+                  .drop_duplicates(['artist_credit_id', 'track']))
+    is_new = ~pd.MultiIndex.from_frame(new_tracks[['artist_credit_id', 'track']]).isin(
+        pd.MultiIndex.from_frame(album_tracks[['artist_credit_id', 'track']])
+    )
+    album_tracks = pd.concat([album_tracks, new_tracks.loc[is_new]], ignore_index = True)
+    return dict(seen_listens, album_tracks = album_tracks)
+
+def process_scrobbles_chunked(scrobbles_fp, processed_scrobbles_fp, chunksize = 100000,
+                              temp_loc = 'data/tmp', timezone = 'America/Los_Angeles', 
+                              seen_listens = None):
+    """
+    process a raw scrobbles csv one chunk at a time so that memory is bounded
+    by the chunk size and the number of unique tracks, not the total number
+    of scrobbles. the first pass counts album names per track, builds the
+    artist credit dimension, and spills each chunk to temp_loc split into
+    time buckets. the second pass processes the buckets in time order and
+    appends them to processed_scrobbles_fp
+    Args:
+        scrobbles_fp (str or pathlib.Path): raw scrobbles csv
+        processed_scrobbles_fp (str or pathlib.Path): output csv for processed scrobbles
+        chunksize (int, default 100000): number of raw scrobbles read at a time
+        temp_loc (str or pathlib.Path, default 'data/tmp'): directory for spilled chunks
+        timezone (str or list, default 'America/Los_Angeles'): timezone name, or
+            list of (from uts, timezone name) periods for users who moved
+        seen_listens (dict, default None): first listens and album counts of 
+            earlier runs (see temporal.read_seen_listens). if None, no earlier listens
+    Returns:
+        tuple: (int number of processed scrobbles written, dict of first listens
+            up to and including these scrobbles)
+    """
+    bucket_seconds = 28 * 24 * 3600 
+    Path(temp_loc).mkdir(parents = True, exist_ok = True)
+    with tempfile.TemporaryDirectory(dir = temp_loc) as temp_dir:
+        # first pass: album counts, artist credits, and time buckets 
+        if seen_listens is None:
+            seen_listens = temporal.new_seen_listens()
+        artist_credits = seen_listens['artist_credits']
+        album_counts = seen_listens['album_counts']
+        bucket_fps = {} # time bucket : list of spilled chunk filepaths 
+        n_rows = 0 if album_counts is None else int(album_counts['plays'].sum())
+        for i, chunk in enumerate(load.read_raw_scrobbles(scrobbles_fp, chunksize)):
+            # fill missing 'uts' from 'utc_time' before bucketing by time
+            chunk['uts'] = temporal.scrobble_uts(chunk)
+            chunk, artist_credits = preprocess.prepare_scrobbles(chunk, artist_credits)
+            chunk_album_counts, _ = preprocess.count_track_albums(chunk, first_row = n_rows)
+            album_counts = preprocess.combine_track_album_counts(album_counts, chunk_album_counts)
+            n_rows += len(chunk)
+            for bucket, bucket_chunk in chunk.groupby(chunk.uts // bucket_seconds):
+                bucket_fp = Path(temp_dir) / f'{bucket}_{i}.pkl'
+                bucket_chunk.to_pickle(bucket_fp)
+                bucket_fps.setdefault(bucket, []).append(bucket_fp)
+        tracks_with_unique_albums = preprocess.choose_final_album_names(album_counts)
+        seen_listens = resolve_seen_albums(seen_listens, artist_credits, album_counts, 
+                                           tracks_with_unique_albums)
+
+        # second pass: process each time bucket in order 
+        open_session = None # scrobbles of the last session, which may continue
+        n_written = 0
+        for bucket in sorted(bucket_fps):
+            bucket_scrobbles = pd.concat([pd.read_pickle(fp) for fp in bucket_fps[bucket]])
+            bucket_scrobbles = preprocess.apply_final_album_names(bucket_scrobbles, album_counts,
+                                                                  tracks_with_unique_albums)
+            bucket_scrobbles = preprocess.add_artist_columns(bucket_scrobbles, artist_credits)
+            bucket_scrobbles, seen_listens = temporal.process_temporal(bucket_scrobbles, timezone, seen_listens)
+            seen_listens = add_album_tracks(seen_listens, bucket_scrobbles)
+            if open_session is None:
+                first_session_id = 0
+            else:
+                first_session_id = open_session.session_id.iloc[0]
+                bucket_scrobbles = pd.concat([
+                    open_session.drop(columns = sessions.SESSION_COLUMNS),
+                    bucket_scrobbles
+                ])
+            bucket_scrobbles = sessions.process_sessions(bucket_scrobbles.reset_index(drop = True),
+                                                         first_session_id, first_scrobble = n_written)
+            is_open = bucket_scrobbles.session_id == bucket_scrobbles.session_id.iloc[-1]
+            open_session = bucket_scrobbles.loc[is_open]
+            closed_sessions, _ = load.compact(bucket_scrobbles.loc[~is_open])
+            closed_sessions.to_csv(processed_scrobbles_fp, index = False,
+                                   mode = 'w' if n_written == 0 else 'a', header = n_written == 0)
+            n_written += len(closed_sessions)
+        if open_session is not None:
+            open_session, _ = load.compact(open_session)
+            open_session.to_csv(processed_scrobbles_fp, index = False,
+                                mode = 'w' if n_written == 0 else 'a', header = n_written == 0)
+            n_written += len(open_session)
+    return n_written, seen_listens
+
 def main(targets):
     """
     run all scripts to process raw scrobbles data via command line
     Args:
-        targets (list): configuration for processing the raw data 
+        targets (list): configuration for processing the raw data. with 
+            'incremental', first listens continue from the state saved by the
+            last incremental run, and the updated state is saved
     Returns:
-        pandas.DataFrame: dataframe with processed streams
+        str: filename of the processed scrobbles csv, in both the default
+            and 'chunked' modes
     """
     BASE_DIR = Path(__file__).parent 
     CONFIG_DIR = BASE_DIR / 'config'
@@ -48,18 +219,30 @@ def main(targets):
         processed_scrobbles_filename = f'{date_str}_test_processed_scrobbles.csv'
         processed_scrobbles_fp = Path(TEST_OUT_DATA_DIR / processed_scrobbles_filename)
         data_config['test_processed_scrobbles_fp'] = processed_scrobbles_filename
+        seen_listens_fp = Path(TEST_OUT_DATA_DIR / data_config['seen_listens_fp'])
     else:
         scrobbles_fp = Path(DATA_DIR / data_config['scrobbles_fp'])
         processed_scrobbles_filename = f'{date_str}_test_processed_scrobbles.csv'
         processed_scrobbles_fp = Path(OUT_DATA_DIR / processed_scrobbles_filename)
         data_config['processed_scrobbles_fp'] = processed_scrobbles_filename
-    processed_scrobbles = preprocess.preprocess_scrobbles_df(scrobbles_fp)
-    processed_scrobbles = temporal.process_temporal(processed_scrobbles)
-    processed_scrobbles = sessions.process_sessions(processed_scrobbles)
-    processed_scrobbles.to_csv(processed_scrobbles_fp, index = False)
+        seen_listens_fp = Path(OUT_DATA_DIR / data_config['seen_listens_fp'])
+    seen_listens = None
+    if 'incremental' in targets and seen_listens_fp.exists():
+        seen_listens = temporal.read_seen_listens(seen_listens_fp)
+    if 'chunked' in targets:
+        _, seen_listens = process_scrobbles_chunked(scrobbles_fp, processed_scrobbles_fp,
+                                                    temp_loc = BASE_DIR / data_config['temp_loc'],
+                                                    timezone = data_config['timezone'],
+                                                    seen_listens = seen_listens)
+    else:
+        processed_scrobbles, seen_listens = process_new_scrobbles(scrobbles_fp, seen_listens, 
+                                                                  data_config['timezone'])
+        processed_scrobbles.to_csv(processed_scrobbles_fp, index = False)
+    if 'incremental' in targets:
+        temporal.save_seen_listens(seen_listens, seen_listens_fp)
     with open(str(BASE_DIR) + '/config/data-params.json', 'w') as file:
         file.write(str(data_config).replace("'", '"'))
-    return processed_scrobbles
+    return processed_scrobbles_filename
 
 if __name__ == '__main__':
     targets = sys.argv[1:]
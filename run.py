@@ -45,16 +45,12 @@ def main(targets):
         session_stats_filename = f'{date_str}_session_stats.csv'
         session_stats_fp = Path(OUT_DATA_DIR / session_stats_filename)
         data_config['test_session_stats_fp'] = session_stats_filename
-    processed_scrobbles = process.process_scrobbles(scrobbles_fp)
+    processed_scrobbles = process.process_scrobbles(scrobbles_fp, data_config['timezone'])
     processed_scrobbles.to_csv(processed_scrobbles_fp, index = False)
-    if len(targets) == 2:
-        n = int(targets[-1])
-    elif len(targets) == 1:
-        if targets[0].isdigit():
-            n = int(targets[0])
-    else: 
-        n = 4
-    session_stats = clustering.run_clustering(processed_scrobbles, n)
+    n = next((int(target) for target in targets if target.isdigit()), 4)
+    model_dir = BASE_DIR / data_config['model_loc']
+    engine = 'minibatch' if 'minibatch' in targets else 'kmeans'
+    session_stats = clustering.run_clustering(processed_scrobbles, n, model_dir, engine)
     session_stats.to_csv(session_stats_fp, index = False)
     with open(str(BASE_DIR) + '/config/data-params.json', 'w') as file:
         file.write(str(data_config).replace("'", '"'))
@@ -0,0 +1,202 @@
+import pandas as pd
+import numpy as np
+import importlib.util
+import hashlib
+
+import src.data.temporal as temporal
+
+# columns of a raw last.fm export that are used for processing. 'uts' is
+# nullable, since scrobbles missing it get their time from 'utc_time'
+RAW_SCROBBLES_SCHEMA = {
+    'uts':'Int64',
+    'utc_time':'str',
+    'artist':'str',
+    'album':'str',
+    'track':'str'
+}
+
+# columns of processed scrobbles that are used by the app and clustering.
+# 'datetime' and 'datetime_local' are rebuilt from 'uts' instead of parsed
+PROCESSED_SCROBBLES_SCHEMA = {
+    'uts':'int64',
+    'artist':'category',
+    'album':'category',
+    'song_title':'category',
+    'album_final':'category',
+    'featured_artists':'category',
+    'primary_artist':'category',
+    'time_of_day':'category',
+    'year':'int16',
+    'month':'int8',
+    'season':'category',
+    'day':'int8',
+    'weekday':'category',
+    'date':'str',
+    'hour':'int8',
+    'first_artist_listen':'bool',
+    'first_song_listen':'bool',
+    'first_album_listen':'bool',
+    'first_listen_any':'bool',
+    'session_id':'int32',
+    'session_length':'float64',
+    'session_start_uts':'int64',
+    'session_end_uts':'int64',
+    'session_position':'int32',
+    'scrobble_ordinal':'int32'
+}
+
+# processed scrobbles columns stored as categoricals, with a fixed order when given
+CATEGORICAL_COLUMNS = {
+    'artist':None,
+    'album':None,
+    'song_title':None,
+    'album_final':None,
+    'featured_artists':None,
+    'primary_artist':None,
+    'time_of_day':['late night', 'morning', 'afternoon', 'evening', 'night'],
+    'season':['winter', 'spring', 'summer', 'fall'],
+    'weekday':['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+}
+
+# helper columns only needed while processing
+HELPER_COLUMNS = ['utc_time', 'artist_mbid', 'album_mbid', 'track_mbid', 
+                  'artist_list', 'artist_sorted', 'artist_key', 'unique_albums']
+
+def read_raw_scrobbles(scrobbles, chunksize = None):
+    """
+    read a raw last.fm export, keeping only the columns used for processing
+    Args:
+        scrobbles (str, pathlib.Path, or file-like): raw scrobbles csv
+        chunksize (int, default None): if given, return an iterator of
+            dataframes with this many scrobbles each
+    Returns:
+        pandas.DataFrame or iterator of pandas.DataFrame: raw scrobbles
+    """
+    return read_scrobbles(scrobbles, RAW_SCROBBLES_SCHEMA, chunksize)
+
+def read_processed_scrobbles(processed_scrobbles, timezone = 'America/Los_Angeles'):
+    """
+    read processed scrobbles, keeping only the columns used by the app and
+    clustering with compact dtypes
+    Args:
+        processed_scrobbles (str, pathlib.Path, or file-like): processed scrobbles csv
+        timezone (str or list, default 'America/Los_Angeles'): timezone name, or
+            list of (from uts, timezone name) periods for 'datetime_local'
+    Returns:
+        pandas.DataFrame: processed scrobbles
+    """
+    processed_scrobbles = read_scrobbles(processed_scrobbles, PROCESSED_SCROBBLES_SCHEMA)
+    uts = processed_scrobbles['uts'].to_numpy()
+    local_times = temporal.local_time_features(uts, timezone)
+    processed_scrobbles['datetime'] = pd.to_datetime(uts, unit = 's', utc = True)
+    processed_scrobbles['datetime_local'] = pd.to_datetime(local_times['local_seconds'].to_numpy(), unit = 's')
+    processed_scrobbles, _ = compact(processed_scrobbles)
+    return processed_scrobbles
+
+def compact(processed_scrobbles):
+    """
+    shrink processed scrobbles for keeping in memory: repeated strings become
+    categoricals, integers are downcast, 'date' is stored as datetime64, and
+    list-valued and other helper columns are dropped or encoded as strings
+    Args:
+        processed_scrobbles (pandas.DataFrame): dataframe of processed scrobbles 
+    Returns:
+        tuple: (pandas.DataFrame compacted scrobbles, int bytes saved)
+    """
+    bytes_before = processed_scrobbles.memory_usage(deep = True).sum()
+    processed_scrobbles = processed_scrobbles.drop(
+        columns = [col for col in HELPER_COLUMNS if col in processed_scrobbles.columns]
+    )
+    if 'featured_artists' in processed_scrobbles.columns:
+        featured_artists = processed_scrobbles['featured_artists']
+        if featured_artists.dtype == object:
+            # lists of 2+ featured artists are joined like the raw artist credit 
+            is_list = featured_artists.map(type) == list
+            featured_artists = featured_artists.where(~is_list, featured_artists[is_list].str.join(', '))
+            processed_scrobbles['featured_artists'] = featured_artists.fillna('')
+    for col, categories in CATEGORICAL_COLUMNS.items():
+        if col not in processed_scrobbles.columns:
+            continue
+        if categories is None:
+            if not isinstance(processed_scrobbles[col].dtype, pd.CategoricalDtype):
+                processed_scrobbles[col] = processed_scrobbles[col].astype('category')
+        else:
+            processed_scrobbles[col] = pd.Categorical(processed_scrobbles[col], 
+                                                      categories = categories, ordered = True)
+    for col in processed_scrobbles.select_dtypes('integer').columns:
+        if not col.endswith('uts'):
+            processed_scrobbles[col] = pd.to_numeric(processed_scrobbles[col], downcast = 'integer')
+    if 'date' in processed_scrobbles.columns:
+        processed_scrobbles['date'] = pd.to_datetime(processed_scrobbles['date'])
+    bytes_saved = bytes_before - processed_scrobbles.memory_usage(deep = True).sum()
+    return processed_scrobbles, bytes_saved
+
+def scrobbles_fingerprint(processed_scrobbles):
+    """
+    hash the content of processed scrobbles, to key results computed from them
+    without hashing the dataframe again
+    Args:
+        processed_scrobbles (pandas.DataFrame): dataframe of processed scrobbles 
+    Returns:
+        str: hex fingerprint
+    """
+    row_hashes = pd.util.hash_pandas_object(processed_scrobbles, index = False).to_numpy()
+    return hashlib.sha256(row_hashes.tobytes()).hexdigest()[:20]
+
+def read_scrobbles(scrobbles, schema, chunksize = None):
+    """
+    read the columns of a scrobbles csv that are in schema with their schema
+    dtypes, using pyarrow's csv parser when it is installed. columns missing
+    from the csv are skipped
+    Args:
+        scrobbles (str, pathlib.Path, or file-like): scrobbles csv
+        schema (dict): {column name: dtype}
+        chunksize (int, default None): if given, return an iterator of
+            dataframes with this many scrobbles each
+    Returns:
+        pandas.DataFrame or iterator of pandas.DataFrame: scrobbles
+    """
+    csv_columns = pd.read_csv(scrobbles, nrows = 0).columns
+    if hasattr(scrobbles, 'seek'):
+        scrobbles.seek(0)
+    usecols = [col for col in csv_columns if col in schema]
+    dtypes = {col:schema[col] for col in usecols}
+    if chunksize is None and importlib.util.find_spec('pyarrow') is not None:
+        return read_csv_pyarrow(scrobbles, dtypes)
+    return pd.read_csv(scrobbles, usecols = usecols, dtype = dtypes, chunksize = chunksize)
+
+def read_csv_pyarrow(scrobbles, dtypes):
+    """
+    read a csv with pyarrow's multithreaded parser. every column is parsed
+    with an explicit type so that strings like '007' are not read as numbers
+    Args:
+        scrobbles (str, pathlib.Path, or file-like): scrobbles csv
+        dtypes (dict): {column name: dtype} of the columns to read
+    Returns:
+        pandas.DataFrame: scrobbles
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    arrow_types = {
+        'str':pa.string(),
+        'category':pa.dictionary(pa.int32(), pa.string()),
+        'bool':pa.bool_(),
+        'float64':pa.float64()
+    }
+    # parse integers as int64 and downcast once in pandas. nullable
+    # integers are parsed the same way and keep their nulls
+    column_types = {col:arrow_types.get(dtype, pa.int64()) for col, dtype in dtypes.items()}
+    if not isinstance(scrobbles, str) and not hasattr(scrobbles, 'read'):
+        scrobbles = str(scrobbles)
+    table = pa_csv.read_csv(
+        scrobbles,
+        convert_options = pa_csv.ConvertOptions(
+            column_types = column_types,
+            include_columns = list(dtypes),
+            strings_can_be_null = True
+        )
+    )
+    scrobbles_df = table.to_pandas()
+    int_cols = {col:dtype for col, dtype in dtypes.items() if dtype.lower().startswith('int')}
+    scrobbles_df = scrobbles_df.astype(int_cols)
+    return scrobbles_df
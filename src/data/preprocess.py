@@ -3,6 +3,8 @@ import re
 import numpy as np
 import pathlib
 
+import src.data.load as load
+
 def preprocess_scrobbles_df(scrobbles):
     """
     preprocess scrobbles to standardize album names for tracks
@@ -17,165 +19,306 @@ def preprocess_scrobbles_df(scrobbles):
     """
     assert type(scrobbles) == str or \
         isinstance(scrobbles, pd.DataFrame) or \
-        isinstance(scrobbles, pathlib._local.PosixPath)
+        isinstance(scrobbles, pathlib.Path)
     if type(scrobbles) == pd.DataFrame:
         scrobbles_df = scrobbles.copy()
     else:
-        scrobbles_df = pd.read_csv(scrobbles)
+        scrobbles_df = load.read_raw_scrobbles(scrobbles)
     columns = ['uts', 'utc_time', 'artist', 'album', 'track']
     df_cols = scrobbles_df.columns.values 
     check_cols = [col in df_cols for col in columns]
     if not all(check_cols):
         return f'column names do not match.\nexpected column names: {columns}.loaded column names: {df_cols}'
+    scrobbles_df, artist_credits = prepare_scrobbles(scrobbles_df)
+    # get scrobbles df with final album col
+    processed_scrobbles = process_albums(scrobbles_df)
+    processed_scrobbles = add_artist_columns(processed_scrobbles, artist_credits)
+    return processed_scrobbles
+
+def preprocess_new_scrobbles(scrobbles_df, artist_credits = None, album_counts = None):
+    """
+    preprocess scrobbles that come after the scrobbles of earlier runs. final
+    album names are chosen from the album counts of the earlier and new
+    scrobbles together, the same as if all of them were processed at once
+    Args:
+        scrobbles_df (pandas.DataFrame): raw scrobbles, modified in place
+        artist_credits (pandas.DataFrame, default None): artist credit
+            dimension of the earlier scrobbles (see create_artist_credits)
+        album_counts (pandas.DataFrame, default None): album counts of the
+            earlier scrobbles (see count_track_albums)
+    Returns:
+        tuple: (pandas.DataFrame of scrobbles like preprocess_scrobbles_df,
+            pandas.DataFrame artist credit dimension, pandas.DataFrame album
+            counts, pandas.DataFrame final album names (see choose_final_album_names),
+            all including the new scrobbles)
+    """
+    scrobbles_df, artist_credits = prepare_scrobbles(scrobbles_df, artist_credits)
+    first_row = 0 if album_counts is None else int(album_counts['plays'].sum())
+    new_album_counts, _ = count_track_albums(scrobbles_df, first_row = first_row)
+    album_counts = combine_track_album_counts(album_counts, new_album_counts)
+    tracks_with_unique_albums = choose_final_album_names(album_counts)
+    processed_scrobbles = apply_final_album_names(scrobbles_df, album_counts, tracks_with_unique_albums)
+    processed_scrobbles = add_artist_columns(processed_scrobbles, artist_credits)
+    return processed_scrobbles, artist_credits, album_counts, tracks_with_unique_albums
+
+def prepare_scrobbles(scrobbles_df, artist_credits = None):
+    """
+    fill missing album names and encode artists as artist credit ids
+    Args:
+        scrobbles_df (pandas.DataFrame): raw scrobbles, modified in place
+        artist_credits (pandas.DataFrame, default None): existing artist
+            credit dimension to extend (see create_artist_credits)
+    Returns:
+        tuple: (pandas.DataFrame of scrobbles with 'artist_credit_id' and
+            'artist_key' columns, pandas.DataFrame artist credit dimension)
+    """
     # replace nan albums with track name
     scrobbles_df['album'] = scrobbles_df['album'].fillna(scrobbles_df['track'])
 
     scrobbles_df['album'] = scrobbles_df['album'].fillna('track')
-    # create cols for unsorted and sorted tups for artists
-    scrobbles_df['artist_list'] = scrobbles_df.artist.str.split(', ')
-    scrobbles_df['artist_sorted'] = scrobbles_df.artist_list.apply(sorted).apply(tuple)
-    # get scrobbles df with final album col
-    processed_scrobbles = process_albums(scrobbles_df)
+    # replace artists with integer codes into the artist credit dimension
+    credit_ids, artist_credits = create_artist_credits(scrobbles_df['artist'], artist_credits)
+    scrobbles_df['artist_credit_id'] = credit_ids
+    scrobbles_df['artist_key'] = artist_credits['artist_key'].values[credit_ids]
+    return scrobbles_df, artist_credits
+
+def add_artist_columns(processed_scrobbles, artist_credits):
+    """
+    add primary and featured artist columns from the artist credit dimension
+    Args:
+        processed_scrobbles (pandas.DataFrame): scrobbles with 'artist_credit_id'
+        artist_credits (pandas.DataFrame): artist credit dimension
+    Returns:
+        pandas.DataFrame: dataframe of scrobbles with 'primary_artist' and
+        'featured_artists' columns and 'track' renamed to 'song_title'
+    """
+    credit_ids = processed_scrobbles['artist_credit_id'].to_numpy()
     # process artists col
-    processed_scrobbles['featured_artists'] =  (
-        np.select(
-            condlist=[
-            processed_scrobbles.artist_list.str.len() == 1, 
-            processed_scrobbles.artist_list.str.len() == 2, 
-            processed_scrobbles.artist_list.str.len() > 2
-            ],
+    processed_scrobbles['featured_artists'] = artist_credits['featured_artists'].values[credit_ids]
+    processed_scrobbles['primary_artist'] = artist_credits['primary_artist'].values[credit_ids]
+    processed_scrobbles.rename(columns = {'track':'song_title'}, inplace=True)
+    return processed_scrobbles
+
+def create_artist_credits(artists, artist_credits = None):
+    """
+    build the artist credit dimension, with one row per unique raw artist
+    string, and encode each scrobble's artist as an integer credit id
+    Args:
+        artists (pandas.Series): raw artist strings of the scrobbles
+        artist_credits (pandas.DataFrame, default None): existing artist
+            credit dimension to extend with any new artist strings
+    Returns:
+        tuple: (numpy.ndarray of int32 credit ids for each scrobble,
+            pandas.DataFrame artist credit dimension indexed by credit id with
+            columns 'artist', 'artist_key', 'artist_sorted', 'primary_artist'
+            and 'featured_artists')
+    """
+    columns = ['artist', 'artist_key', 'artist_sorted', 'primary_artist', 'featured_artists']
+    if artist_credits is None:
+        artist_credits = pd.DataFrame(columns = columns)
+        artist_credits['artist_key'] = artist_credits['artist_key'].astype(np.int32)
+    codes, unique_artists = pd.factorize(artists, use_na_sentinel = False)
+    credit_index = pd.Index(artist_credits['artist'])
+    unique_credit_ids = credit_index.get_indexer(unique_artists)
+    new_artists = pd.Series(unique_artists[unique_credit_ids == -1], dtype = object)
+    if len(new_artists) > 0:
+        artist_list = new_artists.str.split(', ')
+        artist_sorted = artist_list.apply(sorted).apply(tuple)
+        # one key per sorted credit, so 'A, B' and 'B, A' share a key
+        existing_keys = artist_credits.drop_duplicates('artist_key')
+        key_index = pd.Index(existing_keys['artist_sorted'], tupleize_cols = False)
+        new_keys, unique_new_keys = pd.factorize(artist_sorted)
+        unique_key_ids = key_index.get_indexer(unique_new_keys)
+        is_new_key = unique_key_ids == -1
+        unique_key_ids[~is_new_key] = existing_keys['artist_key'].to_numpy()[unique_key_ids[~is_new_key]]
+        unique_key_ids[is_new_key] = len(existing_keys) + np.arange(is_new_key.sum())
+        n_artists = artist_list.str.len().to_numpy()
+        featured_artists = np.select(
+            condlist=[n_artists == 1, n_artists == 2, n_artists > 2],
             choicelist=[
             '', # empty string for songs with no featured artists
-            processed_scrobbles.artist_list.str[1],
-            processed_scrobbles.artist_list.str[1:]
+            artist_list.str[1],
+            artist_list.str[1:]
             ],
-            default=processed_scrobbles.artist_list
-            )
+            default=artist_list
         )
-    processed_scrobbles['primary_artist'] = processed_scrobbles.artist_list.str[0]    
-    processed_scrobbles.rename(columns = {'track':'song_title'}, inplace=True)
-    return processed_scrobbles
+        new_credits = pd.DataFrame({
+            'artist': new_artists.values,
+            'artist_key': unique_key_ids[new_keys].astype(np.int32),
+            'artist_sorted': artist_sorted.values,
+            'primary_artist': artist_list.str[0].values,
+            'featured_artists': featured_artists
+        }, index = len(artist_credits) + np.arange(len(new_artists)))
+        artist_credits = pd.concat([artist_credits, new_credits]) if len(artist_credits) > 0 else new_credits
+        unique_credit_ids[unique_credit_ids == -1] = new_credits.index.to_numpy()
+    credit_ids = unique_credit_ids[codes].astype(np.int32)
+    return credit_ids, artist_credits
 
 def process_albums(scrobbles_df):
     """
-    create standardized albums column for each track 
+    create standardized albums column for each track. every (artist, track,
+    album) combination is counted once with a single groupby, and the album
+    name rules are applied as vectorized passes over that table of counts
     Args:
         scrobbles_df (pandas.DataFrame): df of scrobbles with
-        nan album names filled and column for sorted artists
+        nan album names filled and column for sorted artist key ('artist_key')
     Returns:
         pandas.DataFrame: dataframe of scrobbles with 
         standardized album column ('album_final')
     """
-    scrobbles_unique_tracks = scrobbles_df[['artist_sorted', 'track']].drop_duplicates().copy(deep = True)
-    scrobbles_unique_tracks_and_albums = scrobbles_df[['artist_sorted', 'track', 'album']].drop_duplicates().copy(deep = True)
-    # only keep unique tracks for album processing
-    merged_tracks = pd.merge(scrobbles_unique_tracks, 
-        scrobbles_unique_tracks_and_albums, 
-        on = ['artist_sorted', 'track'], 
-        how='left'
-    )
-    # get all unique album names for each track 
-    tracks_with_unique_albums = merged_tracks.groupby(by = ['artist_sorted','track'])\
-    ['album'].unique().reset_index().rename(columns = {'album':'unique_albums'})                                                                     
-    # get final album name 
-    tracks_with_unique_albums['album_final'] = tracks_with_unique_albums.apply(lambda row:
-        choose_final_album_name(row, scrobbles_df), axis = 1
+    album_counts, track_ids = count_track_albums(scrobbles_df)
+    tracks_with_unique_albums = choose_final_album_names(album_counts)
+    # broadcast each track's final album back to its scrobbles by position
+    scrobbles_df_album_final = scrobbles_df.reset_index(drop = True)
+    scrobbles_df_album_final['unique_albums'] = (
+        tracks_with_unique_albums['unique_albums'].values[track_ids]
     )
-    scrobbles_df_album_final = pd.merge(scrobbles_df, 
-        tracks_with_unique_albums, 
-        on = ['artist_sorted', 'track'], 
-        how = 'left'
+    scrobbles_df_album_final['album_final'] = (
+        tracks_with_unique_albums['album_final'].values[track_ids]
     )
-    return scrobbles_df_album_final    
+    return scrobbles_df_album_final
 
-def catch_special_editions(album_name):
+def count_track_albums(scrobbles_df, first_row = 0):
     """
-    detects whether album name contains common words associated with
-    special editions of albums
+    count scrobbles for every unique (artist, track, album) combination
     Args:
-        album_name (str): name of track's album
+        scrobbles_df (pandas.DataFrame): df of scrobbles with
+        nan album names filled and column for sorted artist key ('artist_key')
+        first_row (int, default 0): row number of the first scrobble, used
+            when counting an export one chunk at a time
     Returns:
-        bool: whether album name likely refers to a special edition. True if
-        album does not. False if it does. 
+        tuple: (pandas.DataFrame with one row per unique artist/track/album and
+            columns 'track_id', 'artist_key', 'track', 'album', 'plays' and
+            'first_seen', numpy.ndarray with the track_id of each scrobble)
     """
-    name_cleaned = re.sub(r'[^a-zA-Z0-9 ]', '', album_name.lower())
-    return not (('deluxe' in name_cleaned) or ('edition' in name_cleaned)\
-    or ('expanded' in name_cleaned)\
-    or ('anniversary' in name_cleaned)) 
+    grouped = scrobbles_df.groupby(['artist_key', 'track', 'album'],
+                                   sort = False, dropna = False)
+    # groups are numbered in order of first appearance
+    album_ids = grouped.ngroup().to_numpy()
+    album_counts = grouped.size().reset_index(name = 'plays')
+    album_counts['first_seen'] = first_row + np.flatnonzero(~pd.Series(album_ids).duplicated().to_numpy())
+    album_counts['track_id'] = album_counts.groupby(['artist_key', 'track'],
+                                                    sort = False, dropna = False).ngroup()
+    track_ids = album_counts['track_id'].to_numpy()[album_ids]
+    return album_counts, track_ids
 
-def find_most_popular_album(row, albums_filt, scrobbles_df):
+def combine_track_album_counts(album_counts, new_album_counts):
     """
-    find album name most scrobbled for a given track 
+    add the album counts of a new chunk of scrobbles to the running counts
     Args:
-        row (pandas.Series): single track (scrobble)
-        albums_filt (list[str]): list of filtered album names 
-        scrobbles_df (pandas.DataFrame): original dataframe of scrobbles
+        album_counts (pandas.DataFrame or None): running output of count_track_albums
+        new_album_counts (pandas.DataFrame): output of count_track_albums for the new chunk
     Returns:
-        str: most popular album name for a given track 
-    """
-    # finally choose most popular 
-    all_scrobbles = scrobbles_df.loc[(scrobbles_df.artist_sorted == \
-        row.artist_sorted) & (scrobbles_df.track == row.track)].copy()
-    # remove parenthetical text
-    # all_scrobbles['album_filtered'] = all_scrobbles.album.str.replace(r' ?[\(\[][^\)\]]*[\)\]]', '', regex=True)
-    album_counts = all_scrobbles.album.value_counts()
-    # only look at cleaned album names
-    album_counts_filtered = album_counts.filter(albums_filt, axis=0)
-    if len(album_counts_filtered) == 0:
-        return album_counts.idxmax()
-    else:
-        return album_counts_filtered.idxmax()
+        pandas.DataFrame: combined album counts with renumbered 'track_id'
+    """
+    if album_counts is None:
+        return new_album_counts
+    album_counts = (
+        pd.concat([album_counts, new_album_counts], ignore_index = True)
+        .groupby(['artist_key', 'track', 'album'], sort = False, dropna = False)
+        .agg(plays = ('plays', 'sum'), first_seen = ('first_seen', 'min'))
+        .reset_index()
+    )
+    album_counts['track_id'] = album_counts.groupby(['artist_key', 'track'],
+                                                    sort = False, dropna = False).ngroup()
+    return album_counts
 
-def choose_final_album_name(row, scrobbles_df):
+def apply_final_album_names(scrobbles_df, album_counts, tracks_with_unique_albums):
     """
-    determines final album name for a given track by removing album names
+    look up the final album name of each scrobble's track in previously
+    resolved album names
+    Args:
+        scrobbles_df (pandas.DataFrame): df of scrobbles with 'artist_key'
+        album_counts (pandas.DataFrame): output of combine_track_album_counts
+        tracks_with_unique_albums (pandas.DataFrame): output of choose_final_album_names
+    Returns:
+        pandas.DataFrame: dataframe of scrobbles with 
+        standardized album column ('album_final')
+    """
+    tracks = album_counts.drop_duplicates('track_id')
+    track_index = pd.MultiIndex.from_arrays([tracks['artist_key'], tracks['track']])
+    track_ids = tracks['track_id'].to_numpy()[track_index.get_indexer(
+        pd.MultiIndex.from_arrays([scrobbles_df['artist_key'], scrobbles_df['track']])
+    )]
+    scrobbles_df = scrobbles_df.reset_index(drop = True)
+    scrobbles_df['unique_albums'] = tracks_with_unique_albums['unique_albums'].values[track_ids]
+    scrobbles_df['album_final'] = tracks_with_unique_albums['album_final'].values[track_ids]
+    return scrobbles_df
+
+def choose_final_album_names(album_counts):
+    """
+    determines final album name for every track by removing album names
     that match the track name and special edition albums. if needed, then
     the most popular album name is chosen for the track
     Args:
-        row (pandas.Series): single track (scrobble)
-        scrobbles_df (pandas.DataFrame): original dataframe of scrobbles
+        album_counts (pandas.DataFrame): output of count_track_albums
     Returns:
-        str: most popular album name for a given track 
+        pandas.DataFrame: one row per track_id with columns 'unique_albums'
+            and 'album_final'
     """
-    album_arr = row.unique_albums.copy()
-    # return album name if only 1 unique one exists 
-    if len(album_arr) == 1:
-        return album_arr[0]
-    else:
-        alphanum_pattern = r'[^a-zA-Z0-9 ]'
-        track_cleaned = re.sub(alphanum_pattern, '', row.track.lower())
-        # remove single names
-        albums_filt_no_singles = list(filter(lambda album: 
-            re.sub(alphanum_pattern, '', album.lower()) != track_cleaned, 
-            album_arr
-        ))
-        if len(albums_filt_no_singles) == 1:
-            return albums_filt_no_singles[0]
-        elif len(albums_filt_no_singles) == 0:
-            return find_most_popular_album(row)
-        else:
-            # prioritize non special edition albums 
-            albums_filt_no_spec_eds = list(filter(
-                catch_special_editions, albums_filt_no_singles
-            ))
-            if len(albums_filt_no_spec_eds) == 1:
-                return albums_filt_no_spec_eds[0]
-            else:
-                if len(albums_filt_no_spec_eds) == 0:
-                    albums_filt_penult = albums_filt_no_singles
-                else:
-                    albums_filt_penult = albums_filt_no_spec_eds
-                # remove parenthetical text 
-                pattern = r' ?[\(\[][^\)\]]*[\)\]]'
-                albums_filt_no_paren = list(map(lambda album: re.sub(pattern, '', album), 
-                    albums_filt_penult
-                ))
-                final_albums_filt = tuple(set(albums_filt_no_paren))
-                if len(final_albums_filt) == 1:
-                    return final_albums_filt[0]
-                elif len(final_albums_filt) == 0:
-                    return find_most_popular_album(row, albums_filt_penult, scrobbles_df)
-                else:
-                    # finally choose most popular 
-                    return find_most_popular_album(row, final_albums_filt, scrobbles_df)
-                
\ No newline at end of file
+    track_ids = album_counts['track_id']
+    n_tracks = track_ids.max() + 1 if len(track_ids) > 0 else 0
+    albums = album_counts['album'].astype(str)
+    alphanum_pattern = r'[^a-zA-Z0-9 ]'
+    albums_cleaned = albums.str.lower().str.replace(alphanum_pattern, '', regex = True)
+    tracks_cleaned = (album_counts['track'].astype(str).str.lower()
+                      .str.replace(alphanum_pattern, '', regex = True))
+    # remove parenthetical text 
+    paren_pattern = r' ?[\(\[][^\)\]]*[\)\]]'
+    albums_no_paren = albums.str.replace(paren_pattern, '', regex = True)
+
+    n_albums = track_ids.map(track_ids.value_counts())
+    # remove single names
+    not_single = albums_cleaned != tracks_cleaned
+    n_not_single = not_single.groupby(track_ids).transform('sum')
+    # prioritize non special edition albums 
+    not_spec_ed = not_single & ~albums_cleaned.str.contains(
+        'deluxe|edition|expanded|anniversary', regex = True
+    )
+    n_not_spec_ed = not_spec_ed.groupby(track_ids).transform('sum')
+    penult = not_spec_ed.where(n_not_spec_ed > 0, not_single)
+    n_no_paren = albums_no_paren.where(penult).groupby(track_ids).transform('nunique')
+    # albums whose exact name matches one of the track's names without parentheticals
+    no_paren_names = pd.MultiIndex.from_arrays([track_ids[penult], albums_no_paren[penult]])
+    matches_no_paren = pd.MultiIndex.from_arrays([track_ids, albums]).isin(no_paren_names)
+    has_match = pd.Series(matches_no_paren, index = album_counts.index).groupby(track_ids).transform('any')
+
+    # most popular album, ties go to the album scrobbled first
+    popularity_order = np.lexsort((album_counts['first_seen'].to_numpy(),
+                                   -album_counts['plays'].to_numpy(),
+                                   track_ids.to_numpy()))
+    album_final = pd.Series(np.nan, index = range(n_tracks), dtype = object)
+    rules = [
+        # 1. only 1 unique album name
+        (n_albums == 1, album_counts['album']),
+        # 2. only 1 album name that isn't the track name
+        (n_not_single == 1, album_counts['album'].where(not_single)),
+        # 3. only album names that match the track name
+        (n_not_single == 0, None),
+        # 4. only 1 non special edition album name
+        (n_not_spec_ed == 1, album_counts['album'].where(not_spec_ed)),
+        # 5. only 1 album name once parentheticals are removed
+        (n_no_paren == 1, albums_no_paren.where(penult)),
+        # 6. most popular of the album names without parentheticals
+        (has_match, album_counts['album'].where(matches_no_paren)),
+        # 7. most popular album name overall
+        (pd.Series(True, index = album_counts.index), None),
+    ]
+    resolved = np.zeros(n_tracks, dtype = bool)
+    for condition, candidates in rules:
+        condition = condition.to_numpy(dtype = bool) & ~resolved[track_ids.to_numpy()]
+        if not condition.any():
+            continue
+        if candidates is None:
+            candidates = album_counts['album']
+        rows = popularity_order[condition[popularity_order] & 
+                                candidates.notna().to_numpy()[popularity_order]]
+        # first row per track in popularity order
+        first_rows = rows[~pd.Series(track_ids.to_numpy()[rows]).duplicated().to_numpy()]
+        chosen_tracks = track_ids.to_numpy()[first_rows]
+        album_final.iloc[chosen_tracks] = candidates.to_numpy()[first_rows]
+        resolved[chosen_tracks] = True
+    tracks_with_unique_albums = album_counts.groupby('track_id', sort = True)['album']\
+        .unique().to_frame(name = 'unique_albums')
+    tracks_with_unique_albums['album_final'] = album_final.values
+    return tracks_with_unique_albums
@@ -1,95 +1,279 @@
 import pandas as pd
 import numpy as np
 
-def process_sessions(processed_scrobbles):
+# columns added by process_sessions
+SESSION_COLUMNS = ['session_id', 'session_length', 'session_start_uts', 'session_end_uts',
+                   'session_position', 'scrobble_ordinal']
+
+# longest breaks in seconds within a listening session to compare
+SESSION_THRESHOLDS = [300, 600, 900, 1800, 3600]
+
+# columns of create_session_stats, in order
+SESSION_STATS_COLUMNS = ['session_id', 'stream_count', 'song_title_nunique', 'primary_artist_nunique', 
+                         'album_nunique', 'session_length', 'weekday', 'season', 'time_of_day_start', 
+                         'first_artist_listen_sum', 'first_song_listen_sum', 'first_album_listen_sum', 
+                         'first_listen_any_sum', 'artist_diversity', 'album_diversity', 
+                         'song_diversity', 'first_listen_ratio']
+
+def process_sessions(processed_scrobbles, first_session_id = 0, threshold = 600, first_scrobble = 0):
     """
-    add listening session features to processed_scrobbles 
+    add listening session features to processed_scrobbles. each session's 
+    attributes are broadcast to its scrobbles by position, without merging
      Args:
         processed_scrobbles (pandas.DataFrame): dataframe of sorted, processed scrobbles 
+        first_session_id (int, default 0): id of the first listening session
+        threshold (int, default 600): longest break in seconds within a session
+        first_scrobble (int, default 0): ordinal of the first scrobble
+    Returns:
+        pandas.DataFrame: dataframe with added session details 
+    """
+    sessions, session_ids = create_sessions(processed_scrobbles, first_session_id, threshold)
+    processed_scrobbles = add_session_columns(processed_scrobbles, sessions, session_ids, first_session_id)
+    processed_scrobbles['scrobble_ordinal'] = np.arange(len(processed_scrobbles)) + first_scrobble
+    processed_scrobbles.reset_index(drop = True, inplace = True)
+    return processed_scrobbles
+
+def add_session_columns(processed_scrobbles, sessions, session_ids, first_session_id = 0):
+    """
+    broadcast each session's id, length, start and end uts, and each scrobble's
+    position within its session, to the scrobbles by position
+    Args:
+        processed_scrobbles (pandas.DataFrame): dataframe of sorted, processed scrobbles 
+        sessions (pandas.DataFrame): output of create_sessions or sessions_from_starts
+        session_ids (numpy.ndarray): session id of each scrobble
+        first_session_id (int, default 0): id of the first listening session
     Returns:
         pandas.DataFrame: dataframe with added session details 
     """
-    sessions, session_rows = create_sessions(processed_scrobbles)
     seconds_to_hours = 3600
-    sessions_diffs = {session_id:(v[1] - v[0])/seconds_to_hours 
-                      for session_id,v in sessions.items()}
-    session_diffs_df = (
-        pd.Series(sessions_diffs)
-        .to_frame(name = 'session_length')
-        .reset_index(drop=False)
-        .rename(columns={'index':'session_id'})
-    )
-    processed_scrobbles['session_id'] = session_rows
-    processed_scrobbles = pd.merge(processed_scrobbles, session_diffs_df, on = 'session_id')
+    session_rows = session_ids - first_session_id
+    start_uts = sessions.start_uts.to_numpy()
+    end_uts = sessions.end_uts.to_numpy()
+    row_numbers = np.arange(len(processed_scrobbles))
+    processed_scrobbles['session_id'] = session_ids
+    processed_scrobbles['session_length'] = ((end_uts - start_uts) / seconds_to_hours)[session_rows]
+    processed_scrobbles['session_start_uts'] = start_uts[session_rows]
+    last_uts = np.where(np.isnan(end_uts), start_uts, end_uts).astype('int64')
+    processed_scrobbles['session_end_uts'] = last_uts[session_rows]
+    processed_scrobbles['session_position'] = row_numbers - sessions.start_row.to_numpy()[session_rows]
     return processed_scrobbles
 
+def create_session_index(processed_scrobbles):
+    """
+    map each listening session to its rows, so a session can be sliced out
+    of processed_scrobbles without scanning every scrobble. sessions must be
+    contiguous, as they are in sorted, processed scrobbles
+    Args:
+        processed_scrobbles (pandas.DataFrame): dataframe of sorted scrobbles with session details 
+    Returns:
+        pandas.DataFrame: first row, end row (exclusive), and start and end uts
+            of each session, indexed by session id
+    """
+    session_ids = processed_scrobbles['session_id'].to_numpy()
+    uts = processed_scrobbles['uts'].to_numpy()
+    is_boundary = session_ids[1:] != session_ids[:-1]
+    has_rows = len(session_ids) > 0
+    start_rows = np.flatnonzero(np.append(has_rows, is_boundary))
+    end_rows = np.flatnonzero(np.append(is_boundary, has_rows)) + 1
+    return pd.DataFrame(
+        {'start_row':start_rows, 'end_row':end_rows, 
+         'start_uts':uts[start_rows], 'end_uts':uts[end_rows - 1]},
+        index = pd.Index(session_ids[start_rows], name = 'session_id')
+    )
+
+def get_session(processed_scrobbles, session_index, session_id):
+    """
+    get the scrobbles of one listening session
+    Args:
+        processed_scrobbles (pandas.DataFrame): dataframe of sorted scrobbles with session details 
+        session_index (pandas.DataFrame): create_session_index of processed_scrobbles
+        session_id (int): id of the session
+    Returns:
+        pandas.DataFrame: scrobbles of the session
+    """
+    i = session_index.index.get_loc(session_id)
+    return processed_scrobbles.iloc[session_index['start_row'].iat[i]:session_index['end_row'].iat[i]]
+
 def create_session_stats(processed_scrobbles):
     """
-    calculate aggregates and statistics on each listening session 
+    calculate aggregates and statistics on each listening session. sessions
+    are contiguous runs of scrobbles, so every aggregate is computed over the
+    session boundaries instead of with a groupby
     Args:
         scrobbles_df (pandas.DataFrame): dataframe of scrobbles with session details 
     Returns:
         pandas.DataFrame: dataframe with aggregates and stats for each session
     """
-    session_stats = processed_scrobbles.groupby('session_id').agg({
-        'song_title': ['count', 'nunique'],
-        'primary_artist': ['nunique'], 
-        'album': ['nunique'],
-        'session_length':['first'],
-        'weekday':['first'],
-        'season':['first'],
-        'time_of_day':['first'],
-        'first_artist_listen':['sum'],
-        'first_song_listen':['sum'],
-        'first_album_listen':['sum'],
-        'first_listen_any':['sum']
-    })
-    session_stats.columns = ['_'.join(col) for col in session_stats.columns]
+    session_ids = processed_scrobbles['session_id'].to_numpy()
+    # rows of each session must be contiguous and in session id order
+    if (np.diff(session_ids) >= 0).all():
+        order = np.arange(len(session_ids))
+        rows = slice(None)
+    else:
+        order = np.argsort(session_ids, kind = 'stable')
+        rows = order
+    session_ids = session_ids[rows]
+    is_start = np.ones(len(session_ids), dtype = bool)
+    is_start[1:] = session_ids[1:] != session_ids[:-1]
+    start_rows = np.flatnonzero(is_start)
+    segment_ids = np.cumsum(is_start) - 1
+
+    session_stats = {'session_id':session_ids[start_rows]}
+    stream_count = segment_sum(processed_scrobbles['song_title'].notna().to_numpy()[rows], start_rows)
+    session_stats['stream_count'] = stream_count
+    for col in ['song_title', 'primary_artist', 'album']:
+        codes = column_codes(processed_scrobbles[col])[rows]
+        session_stats[f'{col}_nunique'] = segment_nunique(codes, segment_ids, start_rows)
+    first_rows = order[start_rows]
+    session_stats['session_length'] = processed_scrobbles['session_length'].to_numpy()[first_rows]
+    for col in ['weekday', 'season', 'time_of_day']:
+        session_stats[col] = processed_scrobbles[col].iloc[first_rows].array
+    for col in ['first_artist_listen', 'first_song_listen', 'first_album_listen', 'first_listen_any']:
+        session_stats[f'{col}_sum'] = segment_sum(processed_scrobbles[col].to_numpy()[rows], start_rows)
     # higher values = higher diversity
-    session_stats['artist_diversity'] = session_stats.primary_artist_nunique / session_stats.song_title_count
-    session_stats['album_diversity'] = session_stats.album_nunique / session_stats.song_title_count
-    session_stats['song_diversity'] = session_stats.song_title_nunique / session_stats.song_title_count
-    session_stats.rename(columns = {
-        'session_length_first':'session_length',
-        'weekday_first':'weekday',
-        'season_first':'season',
-        'song_title_count':'stream_count',
-        'time_of_day_first':'time_of_day_start',
-    }, inplace = True)
-    session_stats['first_listen_ratio'] = (session_stats['first_listen_any_sum'] /
-                                           session_stats['stream_count'])
-    session_stats.reset_index(inplace=True)
-    session_stats.fillna(0, inplace=True)
-    return session_stats
-
-def create_sessions(processed_scrobbles):
+    session_stats['artist_diversity'] = segment_ratio(session_stats['primary_artist_nunique'], stream_count)
+    session_stats['album_diversity'] = segment_ratio(session_stats['album_nunique'], stream_count)
+    session_stats['song_diversity'] = segment_ratio(session_stats['song_title_nunique'], stream_count)
+    session_stats['first_listen_ratio'] = segment_ratio(session_stats['first_listen_any_sum'], stream_count)
+    session_stats = pd.DataFrame(session_stats).rename(columns = {'time_of_day':'time_of_day_start'})
+    session_stats['session_length'] = session_stats['session_length'].fillna(0)
+    return session_stats[SESSION_STATS_COLUMNS]
+
+def column_codes(col):
+    """
+    integer codes of a column's values, -1 for missing values
+    Args:
+        col (pandas.Series): column to encode
+    Returns:
+        numpy.ndarray: code of each value
+    """
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return col.cat.codes.to_numpy()
+    codes, _ = pd.factorize(col)
+    return codes
+
+def segment_sum(values, start_rows):
+    """
+    sum values over contiguous segments
+    Args:
+        values (numpy.ndarray): numeric or boolean values
+        start_rows (numpy.ndarray): sorted first position of each segment
+    Returns:
+        numpy.ndarray: int64 or float64 sum of each segment
+    """
+    if len(start_rows) == 0:
+        return np.zeros(0, dtype = 'int64')
+    dtype = 'float64' if np.issubdtype(values.dtype, np.floating) else 'int64'
+    return np.add.reduceat(values, start_rows, dtype = dtype)
+
+def segment_ratio(counts, stream_counts):
+    """
+    divide per-session counts by the number of streams, 0 for sessions without streams
+    Args:
+        counts (numpy.ndarray): count of each session
+        stream_counts (numpy.ndarray): number of streams of each session
+    Returns:
+        numpy.ndarray: float64 ratio of each session
+    """
+    return np.divide(counts, stream_counts, out = np.zeros(len(counts)), where = stream_counts > 0)
+
+def segment_nunique(codes, segment_ids, start_rows):
+    """
+    count the unique codes in contiguous segments, not counting missing (-1) codes
+    Args:
+        codes (numpy.ndarray): integer code of each row 
+        segment_ids (numpy.ndarray): segment number (0, 1, ...) of each row 
+        start_rows (numpy.ndarray): sorted first position of each segment
+    Returns:
+        numpy.ndarray: number of unique codes in each segment
+    """
+    segment_codes = segment_ids.astype('int64') * (int(codes.max(initial = 0)) + 1) + codes
+    is_new = ~pd.Series(segment_codes).duplicated().to_numpy() & (codes >= 0)
+    return segment_sum(is_new, start_rows)
+
+def create_sessions(processed_scrobbles, first_session_id = 0, threshold = 600):
     """
     extract listening sessions from the scrobbles, where a listening session
     is any consecutive streaming where a break is only 10 minutes or less.
     this threshold tries to accommodate longer song lengths. 
     Args:
         processed_scrobbles (pandas.DataFrame): dataframe of sorted, processed scrobbles 
+        first_session_id (int, default 0): id of the first listening session
+        threshold (int, default 600): longest break in seconds within a session
+    Returns:
+        pandas.DataFrame: first row and start and end uts of each session, indexed
+            by session id. end uts is NaN for sessions with a single scrobble
+        numpy.ndarray: session id of each scrobble
+    """
+    uts = processed_scrobbles['uts'].to_numpy()
+    # a session starts at the first scrobble and after every break over the threshold
+    is_start = np.ones(len(uts), dtype = bool)
+    is_start[1:] = np.diff(uts) > threshold
+    return sessions_from_starts(uts, np.flatnonzero(is_start), first_session_id)
+
+def sweep_session_thresholds(processed_scrobbles, thresholds = SESSION_THRESHOLDS, 
+                             first_session_id = 0):
+    """
+    extract listening sessions for several break thresholds at once. the
+    breaks between scrobbles are computed once and each threshold only 
+    compares them against itself
+    Args:
+        processed_scrobbles (pandas.DataFrame): dataframe of sorted, processed scrobbles 
+        thresholds (list, default SESSION_THRESHOLDS): longest breaks in seconds
+            within a session to try
+        first_session_id (int, default 0): id of the first listening session
     Returns:
-        dict: {session id:[start uts, end uts]}
-        dict: {row index:session id}
-    """
-    session_id = 0
-    sessions = {} # session id : [starting uts, end uts]
-    current_session = [] 
-    threshold = 600
-    session_rows = {} # row index:session id 
-    for i, row in processed_scrobbles.iterrows():
-        if len(current_session) == 0: 
-            current_session = row
-            sessions[session_id] = [row.uts, np.nan]
-        else:
-            if row.uts - current_session.uts <= threshold:
-                sessions[session_id][1] = row.uts
-                current_session = row
-            else:
-                current_session = row
-                session_id += 1
-                sessions[session_id] = [row.uts, np.nan]
-        session_rows[i] = session_id
-    return sessions, session_rows 
+        dict: {threshold:(pandas.DataFrame session start and end uts, 
+            numpy.ndarray session id of each scrobble)}, as in create_sessions
+        pandas.DataFrame: session count, session length (hours) and streams
+            per session stats for each threshold
+    """
+    uts = processed_scrobbles['uts'].to_numpy()
+    gaps = np.diff(uts)
+    seconds_to_hours = 3600
+    threshold_sessions = {}
+    threshold_stats = []
+    for threshold in thresholds:
+        start_rows = np.flatnonzero(gaps > threshold) + 1
+        if len(uts) > 0:
+            start_rows = np.append(0, start_rows)
+        sessions, session_ids = sessions_from_starts(uts, start_rows, first_session_id)
+        threshold_sessions[threshold] = (sessions, session_ids)
+        session_lengths = (sessions.end_uts - sessions.start_uts) / seconds_to_hours
+        stream_counts = np.diff(np.append(start_rows, len(uts)))
+        threshold_stats.append({
+            'threshold':threshold,
+            'session_count':len(sessions),
+            'single_stream_sessions':(stream_counts == 1).sum(),
+            'session_length_median':session_lengths.median(),
+            'session_length_mean':session_lengths.mean(),
+            'session_length_90th_percentile':session_lengths.quantile(0.9),
+            'streams_per_session_median':np.median(stream_counts) if len(uts) else np.nan,
+            'streams_per_session_mean':stream_counts.mean() if len(uts) else np.nan,
+            'streams_per_session_max':stream_counts.max(initial = 0)
+        })
+    return threshold_sessions, pd.DataFrame(threshold_stats)
 
+def sessions_from_starts(uts, start_rows, first_session_id = 0):
+    """
+    build session bounds and session ids from the rows where sessions start
+    Args:
+        uts (numpy.ndarray): sorted uts of each scrobble
+        start_rows (numpy.ndarray): sorted positions of each session's first scrobble
+        first_session_id (int, default 0): id of the first listening session
+    Returns:
+        pandas.DataFrame: first row and start and end uts of each session, indexed
+            by session id. end uts is NaN for sessions with a single scrobble
+        numpy.ndarray: session id of each scrobble
+    """
+    is_start = np.zeros(len(uts), dtype = bool)
+    is_start[start_rows] = True
+    session_ids = np.cumsum(is_start) - 1 + first_session_id
+    end_rows = np.append(start_rows[1:], len(uts))[:len(start_rows)] - 1
+    end_uts = uts[end_rows].astype('float64')
+    end_uts[end_rows == start_rows] = np.nan
+    sessions = pd.DataFrame(
+        {'start_row':start_rows, 'start_uts':uts[start_rows], 'end_uts':end_uts},
+        index = pd.RangeIndex(first_session_id, first_session_id + len(start_rows), name = 'session_id')
+    )
+    return sessions, session_ids
@@ -1,82 +1,326 @@
 import pandas as pd
 import numpy as np
 import pytz
+from datetime import datetime, tzinfo
+from functools import lru_cache
 
-def process_temporal(processed_scrobbles, timezone = 'America/Los_Angeles'):
+# range probed for utc offset transitions of timezones without a pytz
+# transition table, 1970 through 2099
+PROBE_START_UTS = 0
+PROBE_END_UTS = 4102444800
+
+def process_temporal(processed_scrobbles, timezone = 'America/Los_Angeles', seen_listens = None):
     """
     add time related columns to scrobbles dataframe 
     Args:
         processed_scrobbles (pandas.DataFrame): dataframe of processed scrobbles 
+        timezone (str or list, default 'America/Los_Angeles'): timezone name, or
+            list of (from uts, timezone name) periods for users who moved
+        seen_listens (dict, default None): artists, songs, and albums already
+            listened to before these scrobbles (see add_first_listen_flags)
     Returns:
-        pandas.DataFrame: dataframe with added temporal features
+        tuple: (pandas.DataFrame with added temporal features, dict of artists, 
+            songs, and albums listened to up to and including these scrobbles)
     """
     processed_scrobbles = add_temporal_features(processed_scrobbles, timezone)
-    processed_scrobbles.sort_values('uts', inplace=True)
-    processed_scrobbles = add_first_listen_flags(processed_scrobbles)
-    return processed_scrobbles
+    processed_scrobbles.sort_values('uts', kind = 'stable', inplace=True)
+    processed_scrobbles, seen_listens = add_first_listen_flags(processed_scrobbles, seen_listens)
+    return processed_scrobbles, seen_listens
 
 def add_temporal_features(processed_scrobbles, timezone = 'America/Los_Angeles'):
     """
-    add columns for time of day, year, month, season, and day of week 
+    add columns for time of day, year, month, season, and day of week.
+    calendar fields are computed in local time from the integer 'uts' column
     Args:
         processed_scrobbles (pandas.DataFrame): dataframe of processed scrobbles 
+        timezone (str or list, default 'America/Los_Angeles'): timezone name, or
+            list of (from uts, timezone name) periods for users who moved
     Returns:
         pandas.DataFrame: dataframe with added temporal features
     """
-    # Assume your primary timezone
-    curr_timezone = pytz.timezone(timezone) 
-    dates = pd.to_datetime(processed_scrobbles.utc_time, utc = True)
-    processed_scrobbles['time_of_day'] = dates.dt.time
-    processed_scrobbles['year'] = dates.dt.year
-    processed_scrobbles['month'] = dates.dt.month
+    uts = scrobble_uts(processed_scrobbles)
+    processed_scrobbles['uts'] = uts
+    local_times = local_time_features(uts, timezone)
+    hour = local_times['hour'].to_numpy()
+    # (0, 5], (5, 12], (12, 17], (17, 21], (21, 24] with hour 0 included in late night
+    times_of_day = np.array(['late night'] * 6 + ['morning'] * 7 + ['afternoon'] * 5 + 
+                            ['evening'] * 4 + ['night'] * 2, dtype = object)
+    processed_scrobbles['time_of_day'] = times_of_day[hour]
+    days = local_times['local_day'].to_numpy()
+    year, month, day = civil_from_days(days)
+    processed_scrobbles['year'] = year
+    processed_scrobbles['month'] = month
     # add season column
-    seasons = {
-        1:'winter', 2:'winter', 3:'spring', 4:'spring', 5:'spring',
-        6:'summer', 7:'summer', 8:'summer', 9:'fall', 10:'fall',
-        11:'fall', 12:'winter'
-    }
-    processed_scrobbles['season'] = processed_scrobbles['month'].map(seasons)
-    processed_scrobbles['day'] = dates.dt.day
+    seasons = np.array([None, 'winter', 'winter', 'spring', 'spring', 'spring',
+        'summer', 'summer', 'summer', 'fall', 'fall', 'fall', 'winter'
+    ], dtype = object)
+    processed_scrobbles['season'] = seasons[month]
+    processed_scrobbles['day'] = day
     # add weekday column
-    weekdays = {0:'monday', 1:'tuesday', 2:'wednesday', 
-        3:'thursday', 4:'friday', 5:'saturday', 6:'sunday'
-    }
-    processed_scrobbles['weekday'] = dates.dt.dayofweek.map(weekdays)
-    processed_scrobbles['date'] = dates.dt.date
-    processed_scrobbles['datetime'] = dates
-    processed_scrobbles['datetime_local'] = dates.dt.tz_convert(curr_timezone)
-    processed_scrobbles['hour'] = processed_scrobbles['datetime_local'].dt.hour
-    processed_scrobbles['time_of_day'] = pd.cut(
-        processed_scrobbles['hour'],
-        bins=[0, 5, 12, 17, 21, 24],
-        labels=['late night', 'morning', 'afternoon', 'evening', 'night'],
-        include_lowest=True
-    ).astype(str)
+    weekdays = np.array(['monday', 'tuesday', 'wednesday', 
+        'thursday', 'friday', 'saturday', 'sunday'
+    ], dtype = object)
+    processed_scrobbles['weekday'] = weekdays[local_times['weekday'].to_numpy()]
+    processed_scrobbles['date'] = pd.to_datetime(days, unit = 'D')
+    processed_scrobbles['datetime'] = pd.to_datetime(uts, unit = 's', utc = True)
+    # local wall clock time, without timezone so that periods can be mixed
+    processed_scrobbles['datetime_local'] = pd.to_datetime(local_times['local_seconds'].to_numpy(), unit = 's')
+    processed_scrobbles['hour'] = hour.astype(np.int32)
     return processed_scrobbles
 
-def add_first_listen_flags(processed_scrobbles):
+def local_time_features(uts, timezone = 'America/Los_Angeles', tz_aware = False):
+    """
+    convert unix timestamps to local time with one searchsorted over the
+    timezone's utc offset transitions
+    Args:
+        uts (numpy.ndarray): int64 seconds since epoch
+        timezone (str, tzinfo, or list, default 'America/Los_Angeles'): timezone 
+            name or tzinfo, or list of (from uts, timezone) periods. the first 
+            period also applies to any scrobbles before it
+        tz_aware (bool, default False): also return a timezone aware
+            'datetime_local' column. only supported for a single timezone
+    Returns:
+        pandas.DataFrame: 'local_seconds' (int64 seconds since epoch in local
+            wall clock time), 'local_day' (int32 local days since epoch),
+            'hour' (int8), and 'weekday' (int8, monday is 0) for each timestamp
+    """
+    uts = np.asarray(uts, dtype = np.int64)
+    transition_uts, offsets = utc_offset_transitions(normalize_timezone(timezone))
+    offset_ids = np.searchsorted(transition_uts, uts, side = 'right') - 1
+    local_seconds = uts + offsets[np.maximum(offset_ids, 0)]
+    local_day = local_seconds // 86400
+    local_times = pd.DataFrame({
+        'local_seconds': local_seconds,
+        'local_day': local_day.astype(np.int32),
+        'hour': ((local_seconds % 86400) // 3600).astype(np.int8),
+        # 1970-01-01 was a thursday
+        'weekday': ((local_day + 3) % 7).astype(np.int8)
+    })
+    if tz_aware:
+        if not isinstance(timezone, (str, tzinfo)):
+            raise ValueError('tz_aware local times need a single timezone')
+        local_times['datetime_local'] = pd.to_datetime(uts, unit = 's', utc = True).tz_convert(timezone)
+    return local_times
+
+def normalize_timezone(timezone):
+    """
+    convert a timezone argument to a hashable form for utc_offset_transitions
+    Args:
+        timezone (str, tzinfo, or list): timezone name or tzinfo, or list of 
+            (from uts, timezone) periods
+    Returns:
+        str, tzinfo, or tuple: timezone, or tuple of (from uts, timezone) sorted by uts
+    """
+    if isinstance(timezone, (str, tzinfo)):
+        return timezone
+    return tuple(sorted(((int(from_uts), tz) for from_uts, tz in timezone), key = lambda period: period[0]))
+
+@lru_cache(maxsize = 32)
+def utc_offset_transitions(timezone):
+    """
+    build the table of utc offset transitions for a timezone or for periods
+    in different timezones. pytz timezones with a transition table use it, 
+    and the transitions of any other tzinfo (fixed offsets, zoneinfo, dateutil)
+    are found with probe_utc_offset_transitions
+    Args:
+        timezone (str, tzinfo, or tuple): output of normalize_timezone
+    Returns:
+        tuple: (numpy.ndarray of int64 uts at which each offset starts,
+            numpy.ndarray of int64 utc offsets in seconds)
+    """
+    if isinstance(timezone, (str, tzinfo)):
+        tz = pytz.timezone(timezone) if isinstance(timezone, str) else timezone
+        # pytz's table is not public api, so it is only used when it looks as expected
+        transition_times = getattr(tz, '_utc_transition_times', None)
+        transition_info = getattr(tz, '_transition_info', None)
+        if transition_times and transition_info and len(transition_times) == len(transition_info):
+            transition_uts = np.array(transition_times, dtype = 'datetime64[s]').astype(np.int64)
+            offsets = np.array([info[0].total_seconds() for info in transition_info], dtype = np.int64)
+            # first transition is year 1, which covers any earlier timestamp
+            transition_uts[0] = np.iinfo(np.int64).min
+            return transition_uts, offsets
+        return probe_utc_offset_transitions(tz)
+    period_uts = []
+    period_offsets = []
+    for i, (from_uts, tz) in enumerate(timezone):
+        tz_uts, tz_offsets = utc_offset_transitions(tz)
+        start = from_uts if i > 0 else np.iinfo(np.int64).min
+        end = timezone[i + 1][0] if i + 1 < len(timezone) else np.iinfo(np.int64).max
+        # offset in effect when the period starts, then transitions within it
+        start_id = max(np.searchsorted(tz_uts, start, side = 'right') - 1, 0)
+        within = (tz_uts > start) & (tz_uts < end)
+        period_uts.append(np.concatenate([[start], tz_uts[within]]))
+        period_offsets.append(np.concatenate([[tz_offsets[start_id]], tz_offsets[within]]))
+    return np.concatenate(period_uts).astype(np.int64), np.concatenate(period_offsets).astype(np.int64)
+
+def probe_utc_offset_transitions(tz, start_uts = PROBE_START_UTS, end_uts = PROBE_END_UTS):
+    """
+    find the utc offset transitions of any tzinfo by checking its offset once
+    a day, then finding each change to the second. the first offset also 
+    covers earlier timestamps and the last one later timestamps
+    Args:
+        tz (datetime.tzinfo): timezone
+        start_uts (int, default PROBE_START_UTS): first uts probed
+        end_uts (int, default PROBE_END_UTS): last uts probed
+    Returns:
+        tuple: (numpy.ndarray of int64 uts at which each offset starts,
+            numpy.ndarray of int64 utc offsets in seconds)
+    """
+    def utc_offset(uts):
+        return int(datetime.fromtimestamp(uts, tz).utcoffset().total_seconds())
+
+    probe_uts = range(start_uts, end_uts + 1, 86400)
+    transition_uts = [np.iinfo(np.int64).min]
+    offsets = [utc_offset(start_uts)]
+    previous_uts = start_uts
+    for uts in probe_uts:
+        offset = utc_offset(uts)
+        if offset != offsets[-1]:
+            # the offset changes in (low, high]
+            low, high = previous_uts, uts
+            while high - low > 1:
+                middle = (low + high) // 2
+                if utc_offset(middle) == offsets[-1]:
+                    low = middle
+                else:
+                    high = middle
+            transition_uts.append(high)
+            offsets.append(offset)
+        previous_uts = uts
+    return np.array(transition_uts, dtype = np.int64), np.array(offsets, dtype = np.int64)
+
+def scrobble_uts(processed_scrobbles):
+    """
+    get the unix timestamp of each scrobble, parsing 'utc_time' only for
+    scrobbles that are missing 'uts'
+    Args:
+        processed_scrobbles (pandas.DataFrame): dataframe of processed scrobbles 
+    Returns:
+        numpy.ndarray: int64 seconds since epoch for each scrobble
+    """
+    if 'uts' in processed_scrobbles.columns:
+        uts = processed_scrobbles['uts']
+    else:
+        uts = pd.Series(np.nan, index = processed_scrobbles.index)
+    missing = uts.isna()
+    if missing.any():
+        parsed = pd.to_datetime(processed_scrobbles.loc[missing, 'utc_time'], 
+                                format = '%d %b %Y, %H:%M', utc = True)
+        uts = uts.astype('float64')
+        uts[missing] = (parsed - pd.Timestamp(0, tz = 'UTC')) // pd.Timedelta(seconds = 1)
+    return uts.to_numpy().astype(np.int64)
+
+def civil_from_days(days):
+    """
+    convert days since 1970-01-01 to proleptic gregorian calendar dates
+    (Howard Hinnant's civil_from_days algorithm)
+    Args:
+        days (numpy.ndarray): integer days since epoch
+    Returns:
+        tuple: (numpy.ndarray year, numpy.ndarray month, numpy.ndarray day), int32
+    """
+    z = days + 719468
+    era = z // 146097
+    day_of_era = z - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - 
+                   day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    # months counted from march
+    mp = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * mp + 2) // 5 + 1
+    month = np.where(mp < 10, mp + 3, mp - 9)
+    year = year_of_era + era * 400 + (month <= 2)
+    return year.astype(np.int32), month.astype(np.int32), day.astype(np.int32)
+
+def add_first_listen_flags(processed_scrobbles, seen_listens = None):
     """
     designate whether stream was a first listen of that artist, song, and/or album
     Args:
         processed_scrobbles (pandas.DataFrame): dataframe of sorted, processed scrobbles 
+        seen_listens (dict, default None): state from new_seen_listens with
+            the first listen uts of the keys already listened to before these
+            scrobbles. not modified
     Returns:
-        pandas.DataFrame: dataframe with added first listen flags 
+        tuple: (pandas.DataFrame with added first listen flags, dict state like
+            seen_listens that also has the first listens in processed_scrobbles)
     """
-    # For artists
-    processed_scrobbles['first_artist_listen'] = ~processed_scrobbles['primary_artist'].duplicated(keep='first')
-    
-    # For songs (combine artist + song to handle duplicates)
-    processed_scrobbles['song_key'] = processed_scrobbles['primary_artist'] + ' - ' + processed_scrobbles['song_title']
-    processed_scrobbles['first_song_listen'] = ~processed_scrobbles['song_key'].duplicated(keep='first')
-    processed_scrobbles.drop('song_key', axis=1, inplace=True)
-    
-    # For albums (combine artist + album)
-    processed_scrobbles['album_key'] = processed_scrobbles['primary_artist'] + ' - ' + processed_scrobbles['album_final']
-    processed_scrobbles['first_album_listen'] = ~processed_scrobbles['album_key'].duplicated(keep='first')
-    processed_scrobbles.drop('album_key', axis=1, inplace=True)
+    if seen_listens is None:
+        seen_listens = new_seen_listens()
+    uts = processed_scrobbles['uts'].to_numpy()
+    updated_seen_listens = dict(seen_listens)
+    for listen, keys in first_listen_keys(processed_scrobbles).items():
+        seen = seen_listens[listen]
+        is_first = ~pd.Series(keys).duplicated(keep = 'first').to_numpy()
+        if len(seen):
+            is_first &= ~pd.Series(keys).isin(seen.index).to_numpy()
+        new_seen = pd.Series(uts[is_first], index = pd.Index(keys[is_first], name = 'key'), name = 'first_uts')
+        updated_seen_listens[listen] = pd.concat([seen, new_seen]) if len(seen) else new_seen
+        processed_scrobbles[f'first_{listen}_listen'] = is_first
 
     processed_scrobbles['first_listen_any'] = (processed_scrobbles.first_artist_listen | 
                                                processed_scrobbles.first_album_listen | 
                                                processed_scrobbles.first_song_listen)
     
-    return processed_scrobbles
+    return processed_scrobbles, updated_seen_listens
+
+def first_listen_keys(processed_scrobbles):
+    """
+    hash the artist, (artist, song), and (artist, album) of each scrobble to
+    uint64 keys. the hashes are the same across runs and for object or 
+    categorical columns, so keys from earlier runs can be compared
+    Args:
+        processed_scrobbles (pandas.DataFrame): dataframe of processed scrobbles 
+    Returns:
+        dict: {'artist', 'song', 'album'}: numpy.ndarray of uint64 keys
+    """
+    key_columns = {
+        'artist':['primary_artist'],
+        'song':['primary_artist', 'song_title'],
+        'album':['primary_artist', 'album_final']
+    }
+    return {listen:pd.util.hash_pandas_object(processed_scrobbles[cols], index = False).to_numpy()
+            for listen, cols in key_columns.items()}
+
+def new_seen_listens():
+    """
+    empty 'already seen' state for add_first_listen_flags. final album names
+    depend on every scrobble of a track, so the state also keeps what is needed
+    to choose them again once later scrobbles are counted
+    Returns:
+        dict: {'artist', 'song', 'album'}: pandas.Series of first listen uts
+            indexed by uint64 key, 'album_tracks': pandas.DataFrame of the
+            (artist credit, track) pairs listened to with their first listen
+            uts, and 'artist_credits' and 'album_counts': the artist credit
+            dimension and album counts of the scrobbles so far (None when empty,
+            see preprocess.preprocess_new_scrobbles)
+    """
+    seen_listens = {listen:pd.Series(np.array([], dtype = 'int64'), name = 'first_uts',
+                                     index = pd.Index(np.array([], dtype = 'uint64'), name = 'key'))
+                    for listen in ['artist', 'song', 'album']}
+    seen_listens['album_tracks'] = pd.DataFrame({
+        'artist_credit_id':np.array([], dtype = np.int32),
+        'track':np.array([], dtype = object),
+        'first_uts':np.array([], dtype = 'int64')
+    })
+    seen_listens['artist_credits'] = None
+    seen_listens['album_counts'] = None
+    return seen_listens
+
+def save_seen_listens(seen_listens, fp):
+    """
+    save the 'already seen' state so a later run can continue from it
+    Args:
+        seen_listens (dict): state from new_seen_listens/add_first_listen_flags
+        fp (str or pathlib.Path): pickle to save to
+    """
+    pd.to_pickle(seen_listens, fp)
+
+def read_seen_listens(fp):
+    """
+    read an 'already seen' state saved by save_seen_listens
+    Args:
+        fp (str or pathlib.Path): saved pickle
+    Returns:
+        dict: state like new_seen_listens
+    """
+    return pd.read_pickle(fp)
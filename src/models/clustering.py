@@ -1,164 +1,735 @@
 import pandas as pd
 import numpy as np
+import os
+import json
+import hashlib
+import joblib
+import time
+import tracemalloc
+from pathlib import Path
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
 
 import sklearn
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import OneHotEncoder
 from sklearn.compose import ColumnTransformer
 from sklearn.preprocessing import StandardScaler
+from sklearn.preprocessing import FunctionTransformer
 
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.neighbors import KDTree
+from sklearn.metrics import silhouette_score, adjusted_rand_score
 
-from scipy.spatial.distance import cdist
+import plotly.express as px
 
-from sklearn.decomposition import PCA
+import src.data.sessions as sessions
 
-from sklearn.metrics.pairwise import euclidean_distances
+# session stats used to cluster listening sessions
+NUMERIC_FEATURES = ['session_length','artist_diversity', 'song_diversity', 'first_listen_ratio']
+CATEGORICAL_FEATURES = ['weekday', 'season', 'time_of_day_start']
+FEATURES = NUMERIC_FEATURES + CATEGORICAL_FEATURES
 
-import plotly.express as px
+# training engines: full-batch KMeans, or MiniBatchKMeans fit on streamed batches of sessions
+ENGINES = ['kmeans', 'minibatch']
+# fewest partial_fit steps for the 'minibatch' engine, so that few batches still converge
+MIN_PARTIAL_FIT_STEPS = 100
+
+# session stats whose distributions are compared across clusters
+DISTRIBUTION_FEATURES = ['first_listen_ratio', 'artist_diversity', 'album_diversity', 'song_diversity', 
+                         'weekday', 'season', 'stream_count', 'song_title_nunique', 
+                         'primary_artist_nunique', 'album_nunique', 'session_length']
 
-def run_clustering_model(session_stats, n_clusters = 4):
+def run_clustering_model(session_stats, n_clusters = 4, model_dir = None, engine = 'kmeans', 
+                         as_frame = False):
     """
     run all scripts necessary to run the clusters 
     Args:
         session_stats (pandas.DataFrame): dataframe with details on each session
         n_clusters (int, default 4): number of clusters for model to create 
+        model_dir (str or pathlib.Path, default None): directory of saved models. a 
+            model saved for the same session stats, features, and n_clusters is 
+            reused instead of refit, and newly fit models are saved here
+        engine (str, default 'kmeans'): training engine, one of ENGINES
+        as_frame (bool, default False): return the transformed features as a dataframe
+            with a 'cluster' column instead of the sparse feature matrix
     Returns:
-        tuple: (pandas.DataFrame with transformed features for the model, numpy.ndarray with cluster label for each session)
+        tuple: (scipy.sparse.csr_matrix or pandas.DataFrame with transformed features for the model, 
+                numpy.ndarray with cluster label for each session)
     """
-    X_transformed, X_transformed_df = prepare_data(session_stats)
-    new_cols = {og:og.split('__')[1] for og in X_transformed_df.columns}
-    X_transformed_df.rename(columns = new_cols, inplace = True)    
-    cluster_predictions = predict_listening_sessions_clusters(X_transformed, n_clusters)
+    model, _ = get_clustering_model(session_stats, n_clusters, model_dir, engine)
+    preproc = model.named_steps['preprocess']
+    X_transformed = preproc.transform(session_stats[FEATURES])
+    cluster_predictions = model.named_steps['kmeans'].predict(X_transformed)
+    if not as_frame:
+        return X_transformed, cluster_predictions
+    X_transformed_df = features_frame(X_transformed, preproc)
     X_transformed_df['cluster'] = cluster_predictions
     return X_transformed_df, cluster_predictions
 
-def prepare_data(session_stats):
+def create_preprocessor(categories = 'auto'):
     """
-    Preprocess session data by scaling numeric features and one-hot encoding categorical features.
+    Create the transformer that scales numeric features and one-hot encodes categorical features.
+    The output is a float32 sparse matrix, since most of its columns are one-hot columns.
     Args:
-        session_stats (pandas.DataFrame): dataframe with raw session-level features
+        categories (str or list, default 'auto'): categories of each categorical feature,
+            found when fitting if 'auto'
     Returns:
-        tuple: (numpy.ndarray of transformed features, pandas.DataFrame of transformed features with column names)
+        sklearn.compose.ColumnTransformer: unfitted transformer
     """
-    num_feat_filt = ['session_length','artist_diversity', 'song_diversity', 'first_listen_ratio']
-    categ_feat = ['weekday', 'season', 'time_of_day_start']
-    X_session_stats = session_stats[num_feat_filt + categ_feat]
     scalar = StandardScaler()
     pl_standardize = Pipeline([
-        ('standardize', scalar)
+        ('standardize', scalar),
+        ('float32', FunctionTransformer(to_float32, feature_names_out = 'one-to-one'))
     ])
     pl_ohe = Pipeline([
-        ('pos', OneHotEncoder())
+        ('pos', OneHotEncoder(categories = categories, dtype = np.float32))
     ])
     preproc_filt = ColumnTransformer(
         transformers=[
-            ('scaling', pl_standardize, num_feat_filt),
-            ('step_name', pl_ohe, categ_feat)
-        ]
+            ('scaling', pl_standardize, NUMERIC_FEATURES),
+            ('step_name', pl_ohe, CATEGORICAL_FEATURES)
+        ],
+        sparse_threshold = 1
     )
+    return preproc_filt
+
+def to_float32(X):
+    """
+    Cast scaled features to float32. Scaling is done in float64 first so that
+    only the stored features lose precision.
+    Args:
+        X (numpy.ndarray): scaled features
+    Returns:
+        numpy.ndarray: float32 features
+    """
+    return np.asarray(X, dtype = np.float32)
+
+def prepare_data(session_stats, as_frame = False):
+    """
+    Preprocess session data by scaling numeric features and one-hot encoding categorical features.
+    Args:
+        session_stats (pandas.DataFrame): dataframe with raw session-level features
+        as_frame (bool, default False): also return the transformed features as a dataframe
+    Returns:
+        tuple: (scipy.sparse.csr_matrix of float32 transformed features, pandas.DataFrame of 
+                transformed features with column names if as_frame else None)
+    """
+    X_session_stats = session_stats[FEATURES]
+    preproc_filt = create_preprocessor()
     X_transformed = preproc_filt.fit_transform(X_session_stats)
-    X_transformed_df = pd.DataFrame(X_transformed, columns = preproc_filt.get_feature_names_out())
-    return X_transformed, X_transformed_df
+    if not as_frame:
+        return X_transformed, None
+    return X_transformed, features_frame(X_transformed, preproc_filt)
+
+def features_frame(X_transformed, preproc):
+    """
+    Copy transformed features into a dense dataframe named after the session stats features.
+    Args:
+        X_transformed (scipy.sparse.csr_matrix or numpy.ndarray): transformed features
+        preproc (sklearn.compose.ColumnTransformer): fitted preprocessor that transformed them
+    Returns:
+        pandas.DataFrame: transformed features, with a column for each numeric feature and category
+    """
+    if hasattr(X_transformed, 'toarray'):
+        X_transformed = X_transformed.toarray()
+    columns = [col.split('__')[1] for col in preproc.get_feature_names_out()]
+    return pd.DataFrame(X_transformed, columns = columns)
+
+def create_kmeans(n_clusters = 4, engine = 'kmeans', init = 'k-means++', n_init = 'auto'):
+    """
+    Create the KMeans model used to cluster listening sessions.
+    Args:
+        n_clusters (int, default 4): number of clusters to generate
+        engine (str, default 'kmeans'): training engine, one of ENGINES
+        init (str or numpy.ndarray, default 'k-means++'): initialization method,
+            or initial cluster centers
+        n_init (str or int, default 'auto'): number of initializations tried. 
+            always 1 for given centers
+    Returns:
+        sklearn.cluster.KMeans or sklearn.cluster.MiniBatchKMeans: unfitted model
+    """
+    if not isinstance(init, str):
+        n_init = 1
+    if engine == 'minibatch':
+        return MiniBatchKMeans(n_clusters=n_clusters, init=init, random_state=42, n_init=n_init)
+    if engine != 'kmeans':
+        raise ValueError(f"engine must be one of {ENGINES}, not '{engine}'")
+    return KMeans(n_clusters=n_clusters, init=init, random_state=42, n_init=n_init)
 
 def predict_listening_sessions_clusters(X_transformed, n_clusters = 4):
     """
     Fit a KMeans model and return cluster assignments for each session.
     Args:
-        X_transformed (numpy.ndarray): preprocessed feature matrix
+        X_transformed (scipy.sparse.csr_matrix or numpy.ndarray): preprocessed feature matrix, 
+            like the output of prepare_data
         n_clusters (int, default 4): number of clusters to generate
     Returns:
         numpy.ndarray: cluster label for each session
     """
-    kmeans = KMeans(n_clusters=n_clusters, init='k-means++', random_state=42, n_init='auto')
+    kmeans = create_kmeans(n_clusters)
     y_kmeans = kmeans.fit_predict(X_transformed)
     return y_kmeans
 
-def inter_cluster_distributions(col, session_stats):
+def fit_clustering_model(session_stats, n_clusters = 4, engine = 'kmeans', 
+                         batch_size = 16384, n_epochs = 3):
+    """
+    Fit the preprocessing and KMeans pipeline on session stats. with the 
+    'minibatch' engine, only one batch of sessions is transformed at a time. 
+    Sessions that fit in one batch start from the full-batch KMeans clusters. 
+    otherwise the centers start from a full-batch KMeans fit on one random batch 
+    and are updated with passes over the batches, at least MIN_PARTIAL_FIT_STEPS 
+    batches in all
+    Args:
+        session_stats (pandas.DataFrame): dataframe with raw session-level features
+        n_clusters (int, default 4): number of clusters to generate
+        engine (str, default 'kmeans'): training engine, one of ENGINES
+        batch_size (int, default 16384): sessions per batch for the 'minibatch' engine
+        n_epochs (int, default 3): fewest passes over the sessions for the 'minibatch' engine
+    Returns:
+        sklearn.pipeline.Pipeline: fitted 'preprocess' and 'kmeans' steps
+    """
+    model = Pipeline([
+        ('preprocess', create_preprocessor()),
+        ('kmeans', create_kmeans(n_clusters, engine))
+    ])
+    if engine == 'kmeans':
+        model.fit(session_stats[FEATURES])
+        return model
+    preproc = fit_preprocessor_in_batches(session_stats, batch_size)
+    rng = np.random.default_rng(42)
+    if len(session_stats) <= batch_size:
+        # the 'kmeans' engine's clusters, updated once so that the model can be partial_fit
+        init_centers = create_kmeans(n_clusters).fit(preproc.transform(session_stats[FEATURES])).cluster_centers_
+        n_epochs = 1
+    else:
+        first_batch = preproc.transform(session_stats.iloc[rng.permutation(len(session_stats))[:batch_size]][FEATURES])
+        # one k-means++ start can land far from the full-batch clusters, so several are tried
+        init_centers = create_kmeans(n_clusters, n_init = 10).fit(first_batch).cluster_centers_
+        n_batches = -(-len(session_stats) // batch_size)
+        n_epochs = max(n_epochs, -(-MIN_PARTIAL_FIT_STEPS // n_batches))
+    model.steps[0] = ('preprocess', preproc)
+    model.steps[1] = ('kmeans', create_kmeans(n_clusters, engine, init = init_centers))
+    for epoch in range(n_epochs):
+        rows = rng.permutation(len(session_stats))
+        for batch_start in range(0, len(rows), batch_size):
+            batch = session_stats.iloc[rows[batch_start:batch_start + batch_size]]
+            partial_fit_clustering_model(model, batch)
+    return model
+
+def fit_preprocessor_in_batches(session_stats, batch_size = 16384):
+    """
+    Fit the preprocessor without transforming every session. fitting a ColumnTransformer 
+    transforms all of its input, so it is only fit on the first batch, with the 
+    categories of all sessions, and the scaler is updated with each later batch
+    Args:
+        session_stats (pandas.DataFrame): dataframe with raw session-level features
+        batch_size (int, default 16384): sessions per batch
+    Returns:
+        sklearn.compose.ColumnTransformer: transformer fit on all sessions
+    """
+    categories = [np.sort(np.asarray(session_stats[col].dropna().unique()).astype(str)) 
+                  for col in CATEGORICAL_FEATURES]
+    preproc = create_preprocessor(categories)
+    preproc.fit(session_stats.iloc[:batch_size][FEATURES])
+    scaler = preproc.named_transformers_['scaling'].named_steps['standardize']
+    for batch_start in range(batch_size, len(session_stats), batch_size):
+        scaler.partial_fit(session_stats.iloc[batch_start:batch_start + batch_size][NUMERIC_FEATURES])
+    return preproc
+
+def partial_fit_clustering_model(model, session_stats):
+    """
+    Update the cluster centers of a 'minibatch' model with new sessions. the 
+    feature scaling of the model is kept as is
+    Args:
+        model (sklearn.pipeline.Pipeline): model fit with the 'minibatch' engine
+        session_stats (pandas.DataFrame): dataframe with raw session-level features
+    Returns:
+        sklearn.pipeline.Pipeline: updated model
+    """
+    kmeans = model.named_steps['kmeans']
+    if not hasattr(kmeans, 'partial_fit'):
+        raise ValueError("only models fit with the 'minibatch' engine can be updated")
+    kmeans.partial_fit(model.named_steps['preprocess'].transform(session_stats[FEATURES]))
+    return model
+
+def predict_clusters(model, session_stats):
+    """
+    Assign sessions to the clusters of a fitted model, without refitting.
+    Args:
+        model (sklearn.pipeline.Pipeline): output of fit_clustering_model or load_clustering_model
+        session_stats (pandas.DataFrame): dataframe with raw session-level features
+    Returns:
+        numpy.ndarray: cluster label for each session
+    """
+    return model.predict(session_stats[FEATURES])
+
+def clustering_model_key(session_stats, n_clusters = 4, engine = 'kmeans'):
+    """
+    Key a clustering model by what it was fit on: the content of the session stats
+    features, the feature list, n_clusters, the engine, and the scikit-learn version.
+    Args:
+        session_stats (pandas.DataFrame): dataframe with raw session-level features
+        n_clusters (int, default 4): number of clusters
+        engine (str, default 'kmeans'): training engine, one of ENGINES
+    Returns:
+        str: hex key
+    """
+    key_parts = [session_stats_fingerprint(session_stats), FEATURES, int(n_clusters), 
+                 engine, sklearn.__version__]
+    return hashlib.sha256(json.dumps(key_parts).encode()).hexdigest()[:20]
+
+def session_stats_fingerprint(session_stats):
+    """
+    Hash the content of the session stats features.
+    Args:
+        session_stats (pandas.DataFrame): dataframe with raw session-level features
+    Returns:
+        str: hex fingerprint
+    """
+    feature_hashes = pd.util.hash_pandas_object(session_stats[FEATURES], index = False).to_numpy()
+    return hashlib.sha256(feature_hashes.tobytes()).hexdigest()[:20]
+
+def get_clustering_model(session_stats, n_clusters = 4, model_dir = None, engine = 'kmeans'):
+    """
+    Load the saved clustering model for these session stats and n_clusters, or
+    fit one and save it.
+    Args:
+        session_stats (pandas.DataFrame): dataframe with raw session-level features
+        n_clusters (int, default 4): number of clusters
+        model_dir (str or pathlib.Path, default None): directory of saved models. 
+            if None, the model is fit and not saved
+        engine (str, default 'kmeans'): training engine, one of ENGINES
+    Returns:
+        tuple: (sklearn.pipeline.Pipeline fitted model, str model key)
+    """
+    key = clustering_model_key(session_stats, n_clusters, engine)
+    if model_dir is None:
+        return fit_clustering_model(session_stats, n_clusters, engine), key
+    model_fp = Path(model_dir) / f'kmeans_{key}.joblib'
+    if model_fp.exists():
+        return load_clustering_model(model_fp), key
+    model = fit_clustering_model(session_stats, n_clusters, engine)
+    save_clustering_model(model, model_fp)
+    return model, key
+
+def save_clustering_model(model, model_fp):
+    """
+    Save a fitted clustering model. the file is written in full before it
+    replaces model_fp, so readers never see a partial model
+    Args:
+        model (sklearn.pipeline.Pipeline): fitted model
+        model_fp (str or pathlib.Path): file to save to
+    """
+    model_fp = Path(model_fp)
+    model_fp.parent.mkdir(parents = True, exist_ok = True)
+    temp_fp = model_fp.with_name(f'{model_fp.name}.{os.getpid()}.tmp')
+    joblib.dump(model, temp_fp)
+    os.replace(temp_fp, model_fp)
+
+def load_clustering_model(model_fp):
+    """
+    Load a clustering model saved by save_clustering_model.
+    Args:
+        model_fp (str or pathlib.Path): saved model
+    Returns:
+        sklearn.pipeline.Pipeline: fitted model
+    """
+    return joblib.load(model_fp)
+
+def create_neighbors_index(X_transformed, session_ids):
+    """
+    Build a KD-tree over the standardized features of each session to find similar sessions.
+    Args:
+        X_transformed (scipy.sparse.csr_matrix or numpy.ndarray): preprocessed feature matrix,
+            like the output of prepare_data
+        session_ids (array-like): session id of each row of X_transformed
+    Returns:
+        dict: 'tree' (sklearn.neighbors.KDTree) and 'session_ids' (numpy.ndarray)
+    """
+    if hasattr(X_transformed, 'toarray'):
+        X_transformed = X_transformed.toarray()
+    return {'tree':KDTree(X_transformed), 'session_ids':np.asarray(session_ids)}
+
+def get_neighbors_index(session_stats, model_dir = None):
+    """
+    Load the saved neighbors index for these session stats, or build one and save 
+    it next to the clustering models. the index only depends on the session stats
+    features, so it is shared by models with any n_clusters
+    Args:
+        session_stats (pandas.DataFrame): dataframe with raw session-level features
+        model_dir (str or pathlib.Path, default None): directory of saved models. 
+            if None, the index is built and not saved
+    Returns:
+        dict: output of create_neighbors_index
+    """
+    key_parts = [session_stats_fingerprint(session_stats), FEATURES, sklearn.__version__]
+    key = hashlib.sha256(json.dumps(key_parts).encode()).hexdigest()[:20]
+    index_fp = None if model_dir is None else Path(model_dir) / f'neighbors_{key}.joblib'
+    if index_fp is not None and index_fp.exists():
+        return load_clustering_model(index_fp)
+    X_transformed, _ = prepare_data(session_stats)
+    neighbors_index = create_neighbors_index(X_transformed, session_stats['session_id'])
+    if index_fp is not None:
+        save_clustering_model(neighbors_index, index_fp)
+    return neighbors_index
+
+def similar_sessions(neighbors_index, session_id, n_sessions = 5):
     """
-    Plot an overlapping percent histogram of a feature across clusters.
+    Find the sessions with features most similar to a session.
+    Args:
+        neighbors_index (dict): output of create_neighbors_index
+        session_id (int): session to find similar sessions to
+        n_sessions (int, default 5): number of similar sessions
+    Returns:
+        pandas.DataFrame: session_id and distance of the most similar sessions, closest first
+    """
+    tree, session_ids = neighbors_index['tree'], neighbors_index['session_ids']
+    row = pd.Index(session_ids).get_loc(session_id)
+    features = np.asarray(tree.data[row]).reshape(1, -1)
+    n_neighbors = min(n_sessions + 1, len(session_ids))
+    distances, rows = tree.query(features, k = n_neighbors)
+    # the session itself is its own nearest neighbor, at distance 0
+    is_other = rows[0] != row
+    similar = pd.DataFrame({'session_id':session_ids[rows[0][is_other]], 
+                            'distance':distances[0][is_other]})
+    return similar.head(n_sessions)
+
+def representative_sessions(neighbors_index, cluster_labels, n_sessions = 1):
+    """
+    Find the sessions of each cluster nearest to its centroid, the mean of its sessions' features.
+    Args:
+        neighbors_index (dict): output of create_neighbors_index
+        cluster_labels (array-like): cluster of each session in the index
+        n_sessions (int, default 1): number of sessions per cluster
+    Returns:
+        dict: {cluster: list of session ids, most representative first}
+    """
+    features = np.asarray(neighbors_index['tree'].data)
+    session_ids = neighbors_index['session_ids']
+    cluster_labels = np.asarray(cluster_labels)
+    representatives = {}
+    for cluster in np.unique(cluster_labels):
+        # only the cluster's own sessions, since the sessions nearest a centroid 
+        # can belong to a neighboring cluster
+        rows = np.flatnonzero(cluster_labels == cluster)
+        centroid = features[rows].mean(axis = 0)
+        distances = ((features[rows] - centroid) ** 2).sum(axis = 1)
+        nearest = rows[np.argsort(distances, kind = 'stable')[:n_sessions]]
+        representatives[int(cluster)] = session_ids[nearest].tolist()
+    return representatives
+
+def benchmark_engines(session_stats, n_clusters = 4, engines = ENGINES):
+    """
+    Compare the training engines on the same session stats: fit time, peak
+    memory traced while fitting, inertia on all sessions, and agreement 
+    (adjusted rand index) of their clusters with the first engine's.
+    Args:
+        session_stats (pandas.DataFrame): dataframe with raw session-level features
+        n_clusters (int, default 4): number of clusters
+        engines (list, default ENGINES): engines to compare
+    Returns:
+        pandas.DataFrame: engine, fit_seconds, peak_mb, inertia, and agreement
+    """
+    results = []
+    for engine in engines:
+        tracemalloc.start()
+        start = time.perf_counter()
+        model = fit_clustering_model(session_stats, n_clusters, engine)
+        fit_seconds = time.perf_counter() - start
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+        X_transformed = model.named_steps['preprocess'].transform(session_stats[FEATURES])
+        labels = model.named_steps['kmeans'].predict(X_transformed)
+        if engine == engines[0]:
+            reference_labels = labels
+        results.append({
+            'engine':engine,
+            'fit_seconds':fit_seconds,
+            'peak_mb':peak_mb,
+            'inertia':-model.named_steps['kmeans'].score(X_transformed),
+            'agreement':adjusted_rand_score(reference_labels, labels)
+        })
+    return pd.DataFrame(results)
+
+def sweep_n_clusters(session_stats, n_clusters_range = range(2, 7), sample_size = 5000, 
+                     n_jobs = None, model_dir = None):
+    """
+    Fit a KMeans model for each number of clusters in parallel processes and 
+    report inertia, silhouette score, and fit time to help choose n_clusters.
+    the silhouette score is computed on the same random sample of sessions for 
+    every number of clusters, so it stays tractable for many sessions
+    Args:
+        session_stats (pandas.DataFrame): dataframe with raw session-level features
+        n_clusters_range (iterable, default range(2, 7)): numbers of clusters to try
+        sample_size (int, default 5000): number of sessions to compute silhouette scores on
+        n_jobs (int, default None): number of processes. if None, one per number 
+            of clusters up to the number of cpus, or 1 for fewer than 10,000 
+            sessions where starting processes costs more than the fits
+        model_dir (str or pathlib.Path, default None): directory to cache results in,
+            keyed by the session stats fingerprint and sweep settings
+    Returns:
+        pandas.DataFrame: n_clusters, inertia, silhouette, and fit_seconds of each model
+    """
+    n_clusters_range = [int(k) for k in n_clusters_range]
+    if model_dir is not None:
+        key_parts = [session_stats_fingerprint(session_stats), FEATURES, n_clusters_range, 
+                     sample_size, sklearn.__version__]
+        key = hashlib.sha256(json.dumps(key_parts).encode()).hexdigest()[:20]
+        sweep_fp = Path(model_dir) / f'kmeans_sweep_{key}.csv'
+        if sweep_fp.exists():
+            return pd.read_csv(sweep_fp)
+    X_transformed, _ = prepare_data(session_stats)
+    sample_rows = None
+    n_sessions = X_transformed.shape[0]
+    if n_sessions > sample_size:
+        rng = np.random.default_rng(42)
+        sample_rows = np.sort(rng.choice(n_sessions, sample_size, replace = False))
+    if n_jobs is None:
+        n_jobs = min(len(n_clusters_range), os.cpu_count() or 1) if n_sessions >= 10000 else 1
+    if n_jobs == 1:
+        results = [fit_n_clusters(X_transformed, k, sample_rows) for k in n_clusters_range]
+    else:
+        # one thread per process so that the processes don't compete for cores
+        with ProcessPoolExecutor(n_jobs, initializer = threadpool_limits, initargs = (1,)) as pool:
+            results = list(pool.map(fit_n_clusters, repeat(X_transformed), n_clusters_range, 
+                                    repeat(sample_rows)))
+    sweep = pd.DataFrame(results)
+    if model_dir is not None:
+        sweep_fp.parent.mkdir(parents = True, exist_ok = True)
+        sweep.to_csv(sweep_fp, index = False)
+    return sweep
+
+def fit_n_clusters(X_transformed, n_clusters, sample_rows = None):
+    """
+    Fit a KMeans model and score it for sweep_n_clusters.
+    Args:
+        X_transformed (scipy.sparse.csr_matrix or numpy.ndarray): preprocessed feature matrix
+        n_clusters (int): number of clusters
+        sample_rows (numpy.ndarray, default None): rows to compute the silhouette
+            score on. all rows if None
+    Returns:
+        dict: n_clusters, inertia, silhouette, and fit_seconds
+    """
+    start = time.perf_counter()
+    kmeans = create_kmeans(n_clusters).fit(X_transformed)
+    fit_seconds = time.perf_counter() - start
+    labels = kmeans.labels_
+    if sample_rows is not None:
+        X_transformed, labels = X_transformed[sample_rows], labels[sample_rows]
+    n_labels = len(np.unique(labels))
+    if 1 < n_labels < len(labels):
+        silhouette = silhouette_score(X_transformed, labels)
+    else:
+        silhouette = np.nan
+    return {'n_clusters':n_clusters, 'inertia':kmeans.inertia_, 
+            'silhouette':silhouette, 'fit_seconds':fit_seconds}
+
+def suggest_n_clusters(sweep):
+    """
+    Suggest the number of clusters at the elbow of the inertia curve, where 
+    the curve is furthest below the line between its first and last points.
+    Args:
+        sweep (pandas.DataFrame): output of sweep_n_clusters
+    Returns:
+        int: suggested number of clusters
+    """
+    n_clusters = sweep.n_clusters.to_numpy(dtype = float)
+    inertia = sweep.inertia.to_numpy(dtype = float)
+    if len(n_clusters) < 3 or inertia[0] == inertia[-1]:
+        return int(n_clusters[np.nanargmax(sweep.silhouette.to_numpy())])
+    x = (n_clusters - n_clusters[0]) / (n_clusters[-1] - n_clusters[0])
+    y = (inertia - inertia[-1]) / (inertia[0] - inertia[-1])
+    return int(n_clusters[np.argmax((1 - x) - y)])
+
+def create_cluster_histograms(session_stats, features = DISTRIBUTION_FEATURES, n_bins = 20):
+    """
+    Bin features of the sessions of each cluster, as the percent of the cluster's 
+    sessions in each bin. Bins are shared by all clusters: each category of a 
+    categorical feature, whole numbers of an integer feature, or n_bins equal 
+    bins over the range of other features.
+    Args:
+        session_stats (pandas.DataFrame): dataframe of listening session details with a 'cluster' column
+        features (list, default DISTRIBUTION_FEATURES): features to bin
+        n_bins (int, default 20): most bins per feature
+    Returns:
+        dict: {feature: pandas.DataFrame with cluster, feature bin (category or bin center), and percent}
+    """
+    cluster_values, cluster_codes = np.unique(session_stats['cluster'].to_numpy(), return_inverse = True)
+    n_clusters = len(cluster_values)
+    histograms = {}
+    for col in features:
+        values = session_stats[col]
+        if isinstance(values.dtype, pd.CategoricalDtype) or values.dtype == object:
+            # categories in order, or in order of appearance like plotly
+            categories = values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype) else pd.unique(values.dropna())
+            values = pd.Categorical(values, categories = categories)
+            bin_ids = values.codes.astype(np.int64)
+            bins = np.asarray(categories)
+            is_valid = bin_ids >= 0
+        else:
+            values = values.to_numpy(dtype = float)
+            is_valid = ~np.isnan(values)
+            edges = histogram_bin_edges(values[is_valid], n_bins, is_integer = pd.api.types.is_integer_dtype(session_stats[col]))
+            bin_ids = np.clip(np.searchsorted(edges, values, side = 'right') - 1, 0, len(edges) - 2)
+            bins = (edges[:-1] + edges[1:]) / 2
+        n = len(bins)
+        counts = np.bincount(cluster_codes[is_valid] * n + bin_ids[is_valid], 
+                             minlength = n_clusters * n).reshape(n_clusters, n)
+        cluster_sizes = np.maximum(counts.sum(axis = 1, keepdims = True), 1)
+        histograms[col] = pd.DataFrame({
+            'cluster':np.repeat(cluster_values, n),
+            col:np.tile(bins, n_clusters),
+            'percent':(counts / cluster_sizes * 100).ravel()
+        })
+    return histograms
+
+def histogram_bin_edges(values, n_bins = 20, is_integer = False):
+    """
+    Find the bin edges of a numeric feature for create_cluster_histograms.
+    Args:
+        values (numpy.ndarray): feature values, without NaN
+        n_bins (int, default 20): most bins
+        is_integer (bool, default False): if True, bins are whole numbers wide 
+            and centered on whole numbers
+    Returns:
+        numpy.ndarray: n + 1 bin edges for n bins
+    """
+    if len(values) == 0:
+        return np.array([0.0, 1.0])
+    low, high = values.min(), values.max()
+    if is_integer:
+        width = max(1, int(np.ceil((high - low + 1) / n_bins)))
+        return low - 0.5 + width * np.arange(int(np.ceil((high - low + 1) / width)) + 1)
+    return np.histogram_bin_edges(values, bins = n_bins, range = (low, high) if high > low else (low - 0.5, low + 0.5))
+
+def inter_cluster_distributions(col, session_stats, cluster_histograms = None):
+    """
+    Plot the distribution of a feature across clusters as grouped bars of the 
+    percent of each cluster's sessions in each bin. the sessions are binned 
+    here, so the figure's size doesn't grow with the number of sessions
     Args:
         col (str): column name to plot
         session_stats (pandas.DataFrame): dataframe of listening session details
+        cluster_histograms (dict, default None): output of create_cluster_histograms
+            to plot from. if None, only col is binned
     Returns:
-        plotly.graph_objects.Figure: histogram figure
+        plotly.graph_objects.Figure: bar chart figure
     """
+    if cluster_histograms is None or col not in cluster_histograms:
+        cluster_histograms = create_cluster_histograms(session_stats, [col])
+    histogram = cluster_histograms[col].astype({'cluster':str})
     dimension = ' '.join(col.split('_')).title()
-    # pastel1
-    fig = px.histogram(session_stats, x=col, color="cluster", 
-                       barmode="group", histnorm='percent', 
-                       color_discrete_sequence=px.colors.qualitative.Dark2)
+    fig = px.bar(histogram, x=col, y='percent', color="cluster", 
+                 barmode="group", color_discrete_sequence=px.colors.qualitative.Dark2)
     fig.update_layout(
         title_text=f'{dimension} Across Listening Session Clusters', 
         xaxis_title_text=dimension,
         yaxis_title_text='Percent of Sessions', 
+        bargap=0.1
     )
     return fig 
 
-def create_readable_time(time):
+def create_readable_times(times):
+    """
+    Convert times to human-readable 12-hour AM/PM strings.
+    Args:
+        times (pandas.Series): datetimes to format
+    Returns:
+        pandas.Series: formatted time strings (e.g. '9:05 AM')
+    """
+    hours = times.dt.hour
+    hour_strs = hours.where(hours <= 12, hours - 12).astype(str)
+    minute_strs = times.dt.minute.astype(str).str.zfill(2)
+    am_pm = np.where(hours < 12, ' AM', ' PM')
+    return hour_strs + ':' + minute_strs + am_pm
+
+def create_readable_durations(seconds):
     """
-    Convert a time object to a human-readable 12-hour AM/PM string.
+    Convert durations to human-readable hour and minute strings.
     Args:
-        time (datetime.time): time to format
+        seconds (pandas.Series): durations in seconds
     Returns:
-        str: formatted time string (e.g. '9:05 AM')
+        pandas.Series: formatted durations (e.g. '1 hour, 5 minutes')
     """
-    hour = time.hour
-    minutes = time.minute
-    if minutes <= 9:
-        minutes = f'0{minutes}'
-    if hour < 12:
-        return f"{hour}:{minutes} AM"
-    elif hour == 12:
-        return f"{hour}:{minutes} PM"
+    hours = (seconds // 3600).astype(int)
+    minutes = ((seconds % 3600) // 60).astype(int)
+    hour_strs = hours.astype(str) + np.where(hours != 1, ' hours, ', ' hour, ')
+    minute_strs = minutes.astype(str) + np.where(minutes != 1, ' minutes', ' minute')
+    return minute_strs.where(hours == 0, hour_strs + minute_strs)
+
+def create_session_summaries(processed_scrobbles, session_index = None):
+    """
+    Summarize every listening session at once: unique artist/album/song counts,
+    discoveries, start and end times, duration, and time and date descriptions.
+    Args:
+        processed_scrobbles (pandas.DataFrame): sorted scrobble-level dataframe with a 'session_id' column
+        session_index (pandas.DataFrame, default None): sessions.create_session_index of
+            processed_scrobbles. built here if not given
+    Returns:
+        pandas.DataFrame: summary of each session, indexed by session id
+    """
+    if session_index is None:
+        session_index = sessions.create_session_index(processed_scrobbles)
+    start_rows = session_index.start_row.to_numpy()
+    end_rows = session_index.end_row.to_numpy()
+    stream_counts = end_rows - start_rows
+    segment_ids = np.repeat(np.arange(len(start_rows)), stream_counts)
+    summaries = pd.DataFrame({'stream_count':stream_counts}, index = session_index.index)
+    for col in ['primary_artist', 'album_final', 'song_title']:
+        codes = sessions.column_codes(processed_scrobbles[col])
+        summaries[col] = sessions.segment_nunique(codes, segment_ids, start_rows)
+    summaries['discoveries'] = sessions.segment_sum(processed_scrobbles['first_listen_any'].to_numpy(), 
+                                                    start_rows)
+    local_times = pd.to_datetime(processed_scrobbles['datetime_local']).to_numpy()
+    if len(start_rows) > 0:
+        summaries['start_time'] = np.minimum.reduceat(local_times, start_rows)
+        summaries['end_time'] = np.maximum.reduceat(local_times, start_rows)
     else:
-        return f"{hour - 12}:{minutes} PM"
+        summaries['start_time'] = summaries['end_time'] = local_times[:0]
+    summaries['duration_seconds'] = (summaries.end_time - summaries.start_time).dt.total_seconds()
+    summaries['duration'] = create_readable_durations(summaries.duration_seconds)
+
+    weekdays = processed_scrobbles['weekday'].astype(str).str.capitalize().to_numpy()
+    month_names = np.array(['January', 'February', 'March', 'April', 'May', 'June', 'July', 
+                            'August', 'September', 'October', 'November', 'December'])
+    def date_strs(times):
+        return month_names[times.dt.month - 1] + ' ' + times.dt.day.astype(str).str.zfill(2)
+    start_date_strs = date_strs(summaries.start_time)
+    summaries['start_date_description'] = weekdays[start_rows] + ', ' + start_date_strs
+    end_time_strs = create_readable_times(summaries.end_time)
+    ends_later_date = summaries.end_time.dt.normalize() > summaries.start_time.dt.normalize()
+    end_descriptions = end_time_strs.where(
+        ~ends_later_date, 
+        weekdays[end_rows - 1] + ', ' + date_strs(summaries.end_time) + ' ' + end_time_strs
+    )
+    summaries['time_description'] = create_readable_times(summaries.start_time) + ' till ' + end_descriptions
+    return summaries
 
-def session_insights(processed_scrobbles, session_id):
+def session_insights(processed_scrobbles, session_id, session_index = None, session_summaries = None):
     """
     Extract summary statistics and metadata for a single listening session.
     Args:
         processed_scrobbles (pandas.DataFrame): full scrobble-level dataframe with a 'session_id' column
         session_id (int): ID of the session to summarize
+        session_index (pandas.DataFrame, default None): sessions.create_session_index of
+            processed_scrobbles. built here if not given
+        session_summaries (pandas.DataFrame, default None): create_session_summaries of
+            processed_scrobbles. only this session is summarized if not given
     Returns:
         dict: session metrics including unique artist/album/song counts, discoveries, duration,
               time description, date description, and a filtered session dataframe
     """
-    session = processed_scrobbles.loc[processed_scrobbles.session_id == session_id].copy()
-    session['datetime_local'] = pd.to_datetime(session['datetime_local'])
-    listening_session_cols = ['artist', 'album_final', 'song_title']
-    total_discoveries = session.first_listen_any.sum()
-    agg_cols = ['primary_artist', 'album_final', 'song_title']
-    insights_dict = session[agg_cols].nunique().to_dict()
-    insights_dict['discoveries'] = total_discoveries
-    start_time = pd.to_datetime(session.datetime_local.min())
-    start_time_str = create_readable_time(start_time.time())
-    end_time =  pd.to_datetime(session.datetime_local.max())
-    end_time_str = create_readable_time(end_time.time())
-    day_of_week = session.weekday.iloc[0].capitalize()
-    start_date = start_time.date()
-    start_date_str = start_date.strftime("%B %d")
-    end_date = end_time.date()
-    duration = end_time - start_time 
-    seconds = duration.total_seconds()
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    if hours > 0:
-        duration = '{} hour{}, {} minute{}'.format(hours, 's' if hours != 1 else '',
-                                      minutes, 's' if minutes != 1 else '')
-    else: 
-        duration = '{} minute{}'.format(minutes, 's' if minutes != 1 else '')
-    insights_dict['duration'] = duration
-    start_date_description = f"{day_of_week}, {start_date_str}"
-    time_description = f"{start_time_str} till "
-    if end_date > start_date:
-        end_date_str = end_date.strftime("%B %d")
-        end_day_of_week = session.weekday.iloc[-1].capitalize()
-        time_description += f"{end_day_of_week}, {end_date_str} {end_time_str}"
+    if session_index is None:
+        session_index = sessions.create_session_index(processed_scrobbles)
+    session = sessions.get_session(processed_scrobbles, session_index, session_id)
+    if session_summaries is None:
+        summary = create_session_summaries(session).iloc[0]
     else:
-        time_description += f"{end_time_str}"
-    insights_dict['time_description'] = time_description
-    insights_dict['start_date_description'] = start_date_description
-    insights_dict['session_df'] = session[listening_session_cols]
+        summary = session_summaries.loc[session_id]
+    insight_cols = ['primary_artist', 'album_final', 'song_title', 'discoveries', 
+                    'duration', 'time_description', 'start_date_description']
+    insights_dict = summary[insight_cols].to_dict()
+    insights_dict['session_df'] = session[['artist', 'album_final', 'song_title']]
     return insights_dict
@@ -1,13 +1,194 @@
 import plotly.graph_objects as go
 import pandas as pd
+import numpy as np
+import json
+import threading
+from collections import OrderedDict
 
-def create_scrobbles_heatmap(processed_scrobbles, year = 2025, quarter = 0):
+# figures by (dataset fingerprint, chart kind, parameters), least recently used first.
+# module state, so it is shared by every session of the app
+FIGURE_CACHE = OrderedDict()
+FIGURE_CACHE_MAX_BYTES = 64 * 2**20
+FIGURE_CACHE_STATS = {'hits':0, 'misses':0, 'evictions':0, 'bytes':0}
+FIGURE_CACHE_LOCK = threading.Lock()
+
+def cached_figure(create_figure, df_fingerprint, kind, **params):
     """
-    generate heatmap of daily streaming data for given year 
+    get a figure from the figure cache, or create it and cache it. figures
+    are kept until the serialized size of the cached figures passes 
+    FIGURE_CACHE_MAX_BYTES, then the least recently used are evicted. cached 
+    figures are shared between sessions, so they should not be modified
+    Args:
+        create_figure (callable): function with no arguments that creates the figure
+        df_fingerprint (str): fingerprint of the scrobbles the figure is made from.
+            if None, the figure is created and not cached
+        kind (str): name of the chart
+        **params: every other input the figure depends on, like the year
+    Returns:
+        plotly.graph_objects.Figure: figure
+    """
+    if df_fingerprint is None:
+        return create_figure()
+    key = (df_fingerprint, kind, json.dumps(params, sort_keys = True, default = str))
+    with FIGURE_CACHE_LOCK:
+        if key in FIGURE_CACHE:
+            FIGURE_CACHE.move_to_end(key)
+            FIGURE_CACHE_STATS['hits'] += 1
+            return FIGURE_CACHE[key][0]
+        FIGURE_CACHE_STATS['misses'] += 1
+    fig = create_figure()
+    fig_bytes = len(fig.to_json())
+    with FIGURE_CACHE_LOCK:
+        if key not in FIGURE_CACHE:
+            FIGURE_CACHE[key] = (fig, fig_bytes)
+            FIGURE_CACHE_STATS['bytes'] += fig_bytes
+        while FIGURE_CACHE_STATS['bytes'] > FIGURE_CACHE_MAX_BYTES and len(FIGURE_CACHE) > 1:
+            _, (_, evicted_bytes) = FIGURE_CACHE.popitem(last = False)
+            FIGURE_CACHE_STATS['bytes'] -= evicted_bytes
+            FIGURE_CACHE_STATS['evictions'] += 1
+    return fig
+
+def figure_cache_info():
+    """
+    report how the figure cache is doing 
+    Returns:
+        dict: hits, misses, evictions, bytes (serialized size of the cached figures),
+            and entries
+    """
+    with FIGURE_CACHE_LOCK:
+        return {**FIGURE_CACHE_STATS, 'entries':len(FIGURE_CACHE)}
+
+def clear_figure_cache():
+    """
+    empty the figure cache and reset its counters
+    """
+    with FIGURE_CACHE_LOCK:
+        FIGURE_CACHE.clear()
+        FIGURE_CACHE_STATS.update(hits = 0, misses = 0, evictions = 0, bytes = 0)
+
+def create_daily_rollup(processed_scrobbles):
+    """
+    summarize processed scrobbles by day, once per dataset, so that calendars
+    for any year or quarter can be made without going through every scrobble 
+    Args:
+        processed_scrobbles (pd.DataFrame): dataframe of processed scrobbles data 
+    Returns:
+        pd.DataFrame: one row per day with streams, with its date, year, quarter, 
+            month, streams, unique artists, top artist, day of the week (0 is monday),
+            and ISO week
+    """
+    dates = pd.to_datetime(processed_scrobbles['date'])
+    by_date = processed_scrobbles.groupby(dates, sort = True)
+    daily_rollup = pd.DataFrame({
+        'streams':by_date['song_title'].count(),
+        'artists':by_date['primary_artist'].nunique()
+    })
+    # most streamed artist of each day, ties going to the first artist alphabetically
+    artist_counts = (processed_scrobbles.groupby([dates, 'primary_artist'], observed = True, sort = True)
+                     .size().rename('count').reset_index())
+    top_artists = (artist_counts.sort_values('count', ascending = False, kind = 'stable')
+                   .drop_duplicates('date').set_index('date')['primary_artist'])
+    daily_rollup['top_artist'] = top_artists.astype(str)
+    daily_rollup = daily_rollup.rename_axis('date').reset_index()
+    daily_rollup.insert(1, 'year', daily_rollup['date'].dt.year)
+    daily_rollup.insert(2, 'quarter', daily_rollup['date'].dt.quarter)
+    daily_rollup.insert(3, 'month', daily_rollup['date'].dt.month)
+    daily_rollup['day_of_week'] = daily_rollup['date'].dt.dayofweek
+    daily_rollup['week'] = daily_rollup['date'].dt.isocalendar().week.astype(int)
+    return daily_rollup
+
+def create_yearly_rollup(processed_scrobbles):
+    """
+    summarize processed scrobbles by year, once per dataset, so that the overview
+    of any year can be made without going through every scrobble. years and
+    months are local, like the year selector and the streaming calendar
     Args:
         processed_scrobbles (pd.DataFrame): dataframe of processed scrobbles data 
+    Returns:
+        dict: 'years' (years of the 'year' column, newest first), 'totals' 
+            (pd.DataFrame of yearly streams, unique artists, albums and songs, and
+            new artists, indexed by year), and 'tables' ({year: {table name: pd.DataFrame}}
+            of streams by artist, album, song, discovered album, weekday, time of 
+            day, and new artists and albums by month)
+    """
+    years = processed_scrobbles['year']
+    totals = processed_scrobbles.groupby(years).agg(
+        streams=('uts', 'count'),
+        total_streams=('song_title', 'count'),
+        unique_artists=('primary_artist', 'nunique'),
+        unique_albums_raw=('album', 'nunique'),
+        unique_albums=('album_final', 'nunique'),
+        unique_songs=('song_title', 'nunique'),
+        new_artists=('first_artist_listen', 'sum')
+    )
+    # every table is sorted by year, then most streamed or in order within the year
+    by_year = {
+        'artists':(processed_scrobbles.groupby([years, 'primary_artist'], observed=True)
+                   .agg(streams=('uts', 'count'), plays=('song_title', 'count'), 
+                        first_listens=('first_artist_listen', 'sum'))),
+        'albums':(processed_scrobbles.groupby([years, 'album_final', 'primary_artist'], observed=True)
+                  .agg(streams=('uts', 'count'))),
+        'songs':(processed_scrobbles.groupby([years, 'song_title', 'primary_artist'], observed=True)
+                 .agg(streams=('uts', 'count'))),
+        'discovered_albums':(processed_scrobbles.groupby([years, 'album_final'], observed=True)
+                             .agg(streams=('song_title', 'count'), 
+                                  first_listens=('first_album_listen', 'sum'))),
+        'weekday':(processed_scrobbles.groupby([years, 'weekday'], observed=True)
+                   .agg(streams=('song_title', 'count'))),
+        'time_of_day':(processed_scrobbles.groupby([years, 'time_of_day'], observed=True)
+                       .agg(streams=('song_title', 'count')))
+    }
+    for col, flag, name in [('primary_artist', 'first_artist_listen', 'new_artists'), 
+                            ('album_final', 'first_album_listen', 'new_albums')]:
+        is_first_listen = (processed_scrobbles[flag] == True).to_numpy()
+        first_listens = processed_scrobbles[is_first_listen]
+        months = first_listens['datetime_local'].dt.month_name().rename('month')
+        by_year[f'monthly_{name}'] = (first_listens.groupby([years[is_first_listen], months])
+                                      .agg(**{name:(col, 'count')}))
+    ranked_tables = ['artists', 'albums', 'songs', 'discovered_albums']
+    tables = {year:{} for year in totals.index}
+    for table_name, table in by_year.items():
+        empty_table = table.iloc[:0].droplevel('year').reset_index()
+        year_tables = dict(iter(table.groupby(level='year', sort=True)))
+        for year in totals.index:
+            if year not in year_tables:
+                tables[year][table_name] = empty_table
+                continue
+            year_table = year_tables[year].droplevel('year').reset_index()
+            if table_name in ranked_tables:
+                year_table = year_table.sort_values('streams', ascending=False)
+            tables[year][table_name] = year_table
+    return {
+        'years':sorted(processed_scrobbles['year'].unique(), reverse=True),
+        'totals':totals,
+        'tables':tables
+    }
+
+def year_rollup(yearly_rollup, year):
+    """
+    get the totals and tables of one year from create_yearly_rollup, with no 
+    streams and empty tables for a year without scrobbles
+    Args:
+        yearly_rollup (dict): output of create_yearly_rollup
+        year (int): year
+    Returns:
+        tuple: (pd.Series totals, dict {table name: pd.DataFrame})
+    """
+    totals = yearly_rollup['totals'].reindex([year], fill_value=0).iloc[0]
+    tables = yearly_rollup['tables'].get(year)
+    if tables is None:
+        # the tables of any other year have the columns
+        columns = next(iter(yearly_rollup['tables'].values()))
+        tables = {table_name:table.iloc[:0] for table_name, table in columns.items()}
+    return totals, tables
+
+def create_scrobbles_heatmap(daily_rollup, year = 2025, quarter = 0):
+    """
+    generate heatmap of daily streaming data for given year 
+    Args:
+        daily_rollup (pd.DataFrame): output of create_daily_rollup
         year (int): year to generate heatmap for (default, 2025)
-        quarter (int): quarter of the year 
+        quarter (int): quarter of the year, or 0 for the full year
     Returns:
         plotly.graph_objects.Figure: heatmap of daily streaming data 
     """
@@ -18,7 +199,7 @@ def create_scrobbles_heatmap(processed_scrobbles, year = 2025, quarter = 0):
         3:'orrd',
         4:'blues'
     }
-    processed_scrobbles_filt, heatmap_data, hover_data, month_starts = prepare_heatmap_data(processed_scrobbles, year, quarter)
+    heatmap_data, hover_data, month_starts = prepare_heatmap_data(daily_rollup, year, quarter)
     if quarter == 0:
         title = f"{year} Listening Activity"
     else:
@@ -53,100 +234,61 @@ def create_scrobbles_heatmap(processed_scrobbles, year = 2025, quarter = 0):
         height=400,
         xaxis=dict(side='top')
     )
-    return processed_scrobbles_filt, fig 
+    return fig 
 
-def prepare_heatmap_data(processed_scrobbles, year, quarter):
+def prepare_heatmap_data(daily_rollup, year, quarter):
     """
-    extract listening sessions from the scrobbles, where a listening session
-    is any consecutive streaming where a break is only 10 minutes or less.
-    this threshold tries to accommodate longer song lengths. 
+    lay out the days of a year or quarter of the daily rollup as a calendar, 
+    with a row per day of the week and a column per week. each day is placed 
+    in its cell straight from its day of the year
     Args:
-        processed_scrobbles (pd.DataFrame): dataframe of sorted, processed scrobbles 
+        daily_rollup (pd.DataFrame): output of create_daily_rollup
         year (int): year to generate heatmap for (default, 2025)
-        quarter (int): quarter of the year 
+        quarter (int): quarter of the year, or 0 for the full year
     Returns:
-        tuple (processed_scrobbles, pd.DataFrame, pd.DataFrame, pd.DataFrame):
-            the original df of processed scrobbles, the data for the heatmap,
+        tuple (pd.DataFrame, pd.DataFrame, pd.DataFrame): the data for the heatmap,
             the text for the visualization, and data for the week number that starts each month
     """
-    if quarter == 1:
-        min_month = 1
-        max_month = 3
-        max_days = 31
-    elif quarter == 2:
-        min_month = 4
-        max_month = 6
-        max_days = 30
-    elif quarter == 3:
-        min_month = 7
-        max_month = 9
-        max_days = 30
-    elif quarter == 4:
-        min_month = 10
-        max_month = 12
-        max_days = 31
-    else:
-        min_month = 1
-        max_month = 12
-        max_days = 31
     if quarter == 0:
-        processed_scrobbles = processed_scrobbles.loc[
-            (processed_scrobbles.year == year)
-        ].copy()
+        min_month, max_month = 1, 12
     else:
-        processed_scrobbles = processed_scrobbles.loc[
-            (processed_scrobbles.year == year) & 
-            (processed_scrobbles.datetime.dt.quarter == quarter)
-        ].copy()
-    daily_data = processed_scrobbles.groupby('date').agg(
-        streams=('song_title', 'count'),
-        artists=('primary_artist', 'nunique'),
-        weekday = ('weekday', 'first'),
-        month = ('month', 'first'),
-        top_artist=('primary_artist', 
-                    lambda artists: artists.value_counts().index[0] if len(artists) > 0 else 'None')
-    ).reset_index()
+        min_month, max_month = 3 * quarter - 2, 3 * quarter
+    start = pd.Timestamp(year, min_month, 1)
+    end = pd.Timestamp(year, max_month, 1) + pd.offsets.MonthEnd(0)
+    dates = pd.date_range(start, end, freq = 'D')
+    # ISO week numbers, except that late december days in week 1 of the next year 
+    # are week 53 and early january days in the last week of the previous year are week 0
+    jan_1_weekday = pd.Timestamp(year, 1, 1).dayofweek
+    weeks = (dates.dayofyear.to_numpy() - 1 + jan_1_weekday) // 7 + int(jan_1_weekday <= 3)
+    days_of_week = dates.dayofweek.to_numpy()
+    week_values = np.arange(weeks[0], weeks[-1] + 1)
 
-    daily_data['date'] = pd.to_datetime(daily_data['date'])
-    date_range = pd.date_range(
-        start=f'{year}-{str(min_month).zfill(2)}-01',
-        end=f'{year}-{str(max_month).zfill(2)}-{max_days}', 
-        freq='D'
-    )
-    full_season = pd.DataFrame({'date': date_range.date})
-    full_season['date'] = pd.to_datetime(full_season['date'])
-    calendar_data = full_season.merge(daily_data, on='date', how='left')
-    calendar_data.fillna(0, inplace=True)
-    calendar_data['date'] = pd.to_datetime(calendar_data['date'])
-    calendar_data['month'] = calendar_data['date'].dt.month_name()
-    calendar_data['week'] = calendar_data['date'].dt.isocalendar().week
-    calendar_data['day_of_week'] = calendar_data['date'].dt.dayofweek
-    
-    if quarter == 0 or quarter == 4:
-        calendar_data.loc[(calendar_data['month'] == 'December') & (calendar_data['week'] == 1), 'week'] = 53
+    daily_data = daily_rollup.loc[(daily_rollup.date >= start) & (daily_rollup.date <= end)]
+    day_rows = (daily_data['date'] - start).dt.days.to_numpy()
+    streams = np.zeros(len(dates))
+    streams[day_rows] = daily_data['streams'].to_numpy()
+    artists = np.zeros(len(dates), dtype = int)
+    artists[day_rows] = daily_data['artists'].to_numpy()
+    top_artists = np.full(len(dates), '', dtype = object)
+    top_artists[day_rows] = daily_data['top_artist'].to_numpy()
 
-    calendar_data['hover_text'] = calendar_data.apply(
-        lambda row: f"<b>{row['date'].strftime('%B %d, %Y')}</b><br>" +
-                    f"Streams: {int(row['streams'])}<br>" +
-                    f"Unique Artists: {int(row['artists'])}<br>" +
-                    f"Top Artist: {row['top_artist']}" if row['streams'] > 0 
-                    else f"<b>{row['date'].strftime('%B %d, %Y')}</b><br>No streams",
-        axis=1
-    )
-    heatmap_data = calendar_data.pivot_table(
-        index='day_of_week', 
-        columns='week', 
-        values='streams',
-        aggfunc='sum' 
-    ).fillna(0)
-    hover_data = calendar_data.pivot_table(
-        index='day_of_week', 
-        columns='week', 
-        values='hover_text',
-        aggfunc='first' 
-    )
+    date_text = '<b>' + pd.Series(dates.strftime('%B %d, %Y')) + '</b><br>'
+    stream_text = ('Streams: ' + pd.Series(streams.astype(int).astype(str)) + 
+                   '<br>Unique Artists: ' + pd.Series(artists.astype(str)) + 
+                   '<br>Top Artist: ' + pd.Series(top_artists))
+    hover_text = date_text + stream_text.where(streams > 0, 'No streams')
+
+    z = np.zeros((7, len(week_values)))
+    z[days_of_week, weeks - week_values[0]] = streams
+    text = np.full((7, len(week_values)), np.nan, dtype = object)
+    text[days_of_week, weeks - week_values[0]] = hover_text.to_numpy()
+    heatmap_data = pd.DataFrame(z, index = pd.RangeIndex(7, name = 'day_of_week'), 
+                                columns = pd.Index(week_values, name = 'week'))
+    hover_data = pd.DataFrame(text, index = heatmap_data.index, columns = heatmap_data.columns)
     # get first week number for each month 
-    month_starts = calendar_data.groupby('month').agg(
-        week_start=('week', 'min'),
-    ).reset_index().sort_values('week_start')
-    return processed_scrobbles, heatmap_data, hover_data, month_starts
+    month_firsts = dates.day == 1
+    month_starts = pd.DataFrame({
+        'month':dates[month_firsts].month_name(),
+        'week_start':weeks[month_firsts]
+    })
+    return heatmap_data, hover_data, month_starts
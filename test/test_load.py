@@ -0,0 +1,40 @@
+import pandas as pd
+
+import process_data
+import src.data.load as load
+import src.data.temporal as temporal
+
+RAW_SCROBBLES_CSV = '''uts,utc_time,artist,artist_mbid,album,album_mbid,track,track_mbid
+1674599197,"24 Jan 2023, 22:26","Beyoncé, Grace Jones, Tems",,RENAISSANCE,,MOVE (feat. Grace Jones & Tems),
+,"04 Oct 2022, 23:38",Beyoncé,,BREAK MY SOUL,,BREAK MY SOUL,
+1664926699,"04 Oct 2022, 23:38",Beyoncé,,BREAK MY SOUL,,BREAK MY SOUL,
+'''
+
+def write_raw_scrobbles(tmp_path):
+    scrobbles_fp = tmp_path / 'raw_scrobbles.csv'
+    scrobbles_fp.write_text(RAW_SCROBBLES_CSV, encoding = 'utf-8')
+    return scrobbles_fp
+
+def test_read_raw_scrobbles_blank_uts(tmp_path):
+    scrobbles_fp = write_raw_scrobbles(tmp_path)
+    raw_scrobbles = load.read_raw_scrobbles(scrobbles_fp)
+    assert raw_scrobbles['uts'].isna().tolist() == [False, True, False]
+    # blank uts is filled from utc_time, to the minute
+    uts = temporal.scrobble_uts(raw_scrobbles)
+    assert uts.tolist() == [1674599197, 1664926680, 1664926699]
+
+def test_read_raw_scrobbles_chunked_blank_uts(tmp_path):
+    scrobbles_fp = write_raw_scrobbles(tmp_path)
+    chunks = list(load.read_raw_scrobbles(scrobbles_fp, chunksize = 2))
+    raw_scrobbles = pd.concat(chunks, ignore_index = True)
+    assert raw_scrobbles['uts'].isna().tolist() == [False, True, False]
+
+def test_process_scrobbles_blank_uts(tmp_path):
+    scrobbles_fp = write_raw_scrobbles(tmp_path)
+    processed_scrobbles = process_data.process_scrobbles(scrobbles_fp)
+    assert sorted(processed_scrobbles['uts']) == [1664926680, 1664926699, 1674599197]
+    processed_scrobbles_fp = tmp_path / 'processed_scrobbles.csv'
+    n_written, _ = process_data.process_scrobbles_chunked(scrobbles_fp, processed_scrobbles_fp,
+                                                          chunksize = 2, temp_loc = tmp_path / 'tmp')
+    assert n_written == 3
+    assert sorted(pd.read_csv(processed_scrobbles_fp)['uts']) == [1664926680, 1664926699, 1674599197]
@@ -0,0 +1,14 @@
+import pandas as pd
+
+import process_data
+import src.data.sessions as sessions
+
+def test_add_session_columns_matches_process_sessions():
+    processed_scrobbles = process_data.process_scrobbles('test/testdata/test_raw_scrobbles.csv')
+    threshold_sessions, _ = sessions.sweep_session_thresholds(processed_scrobbles)
+    # re-split into 30 minute sessions, as the model training page does
+    year_sessions, session_ids = threshold_sessions[1800]
+    resplit = sessions.add_session_columns(processed_scrobbles.copy(), year_sessions, session_ids)
+    expected = sessions.process_sessions(processed_scrobbles.copy(), threshold = 1800)
+    columns = ['session_id', 'session_length', 'session_start_uts', 'session_end_uts', 'session_position']
+    pd.testing.assert_frame_equal(resplit[columns], expected[columns], check_dtype = False)
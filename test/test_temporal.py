@@ -0,0 +1,84 @@
+import zoneinfo
+
+import numpy as np
+import pandas as pd
+import pytest
+import pytz
+
+import process_data
+import src.data.temporal as temporal
+
+# a second before and at each 2023 daylight saving transition in los angeles
+DST_TRANSITION_UTS = np.array([1678615199, 1678615200, 1699174799, 1699174800], dtype = np.int64)
+
+def tz_convert_local_seconds(uts, timezone):
+    local_datetimes = pd.to_datetime(uts, unit = 's', utc = True).tz_convert(timezone).tz_localize(None)
+    return (local_datetimes - pd.Timestamp(0)) // pd.Timedelta(seconds = 1)
+
+@pytest.mark.parametrize('timezone', [
+    'America/Los_Angeles',
+    zoneinfo.ZoneInfo('America/Los_Angeles'),
+    'UTC',
+    'Etc/GMT+5',
+    pytz.FixedOffset(330),
+])
+def test_local_time_features_dst_transition(timezone):
+    local_times = temporal.local_time_features(DST_TRANSITION_UTS, timezone)
+    expected = tz_convert_local_seconds(DST_TRANSITION_UTS, timezone)
+    assert local_times['local_seconds'].tolist() == list(expected)
+
+def test_local_time_features_dst_hours():
+    local_times = temporal.local_time_features(DST_TRANSITION_UTS, 'America/Los_Angeles')
+    # 01:59:59 pst to 03:00 pdt, then 01:59:59 pdt back to 01:00 pst
+    assert local_times['hour'].tolist() == [1, 3, 1, 1]
+
+def test_local_time_features_periods():
+    # moved from los angeles to new york at the spring transition
+    periods = [(1678615200, zoneinfo.ZoneInfo('America/New_York')), (0, 'America/Los_Angeles')]
+    local_times = temporal.local_time_features(DST_TRANSITION_UTS, periods)
+    expected = np.concatenate([
+        tz_convert_local_seconds(DST_TRANSITION_UTS[:1], 'America/Los_Angeles'),
+        tz_convert_local_seconds(DST_TRANSITION_UTS[1:], 'America/New_York')
+    ])
+    assert local_times['local_seconds'].tolist() == list(expected)
+
+def test_first_listens_split_run_matches_single_run(tmp_path):
+    raw_scrobbles = pd.read_csv('test/testdata/test_raw_scrobbles.csv')
+    raw_scrobbles = raw_scrobbles.sort_values('uts', kind = 'stable', ignore_index = True)
+    flags = ['first_artist_listen', 'first_song_listen', 'first_album_listen', 'first_listen_any']
+    single_run = process_data.process_scrobbles(raw_scrobbles)
+    # albums are keyed by the final album name chosen from every scrobble
+    album_keys = single_run[['primary_artist', 'album_final']].astype(str)
+    assert single_run['first_album_listen'].tolist() == (~album_keys.duplicated()).tolist()
+
+    seen_listens_fp = tmp_path / 'seen_listens.pkl'
+    seen_listens = None
+    for start, end in [(0, 200), (200, 350), (350, len(raw_scrobbles))]:
+        processed_batch, seen_listens = process_data.process_new_scrobbles(raw_scrobbles.iloc[start:end],
+                                                                           seen_listens)
+        temporal.save_seen_listens(seen_listens, seen_listens_fp)
+        seen_listens = temporal.read_seen_listens(seen_listens_fp)
+        # each batch matches a single run of every scrobble up to its end
+        prefix_run = process_data.process_scrobbles(raw_scrobbles.iloc[:end]).iloc[start:]
+        assert processed_batch['uts'].tolist() == prefix_run['uts'].tolist()
+        assert processed_batch['album_final'].tolist() == prefix_run['album_final'].tolist()
+        for flag in flags:
+            assert processed_batch[flag].tolist() == prefix_run[flag].tolist(), flag
+    # so the last batch matches the single run
+    for flag in flags:
+        assert processed_batch[flag].tolist() == single_run[flag].iloc[350:].tolist(), flag
+
+def test_add_first_listen_flags_returns_new_state():
+    scrobbles = pd.DataFrame({
+        'uts':[1, 2, 3],
+        'primary_artist':['a', 'a', 'b'],
+        'song_title':['x', 'y', 'x'],
+        'album_final':['p', 'p', 'q']
+    })
+    seen_listens = temporal.new_seen_listens()
+    flagged, updated_seen_listens = temporal.add_first_listen_flags(scrobbles.copy(), seen_listens)
+    assert all(len(seen_listens[listen]) == 0 for listen in ['artist', 'song', 'album'])
+    assert flagged['first_album_listen'].tolist() == [True, False, True]
+    assert updated_seen_listens['artist'].tolist() == [1, 3]
+    flagged, _ = temporal.add_first_listen_flags(scrobbles.copy(), updated_seen_listens)
+    assert not flagged['first_listen_any'].any()
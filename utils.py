@@ -4,18 +4,34 @@ import numpy as np
 import src.visualize as visualize  
 import src.models.clustering as clustering 
 
-def render_calendar(df, year, quarter):
+# session summary columns shown in tables of sessions, with their display names
+SESSION_SUMMARY_COLUMNS = {
+    'start_date_description':'Date',
+    'time_description':'Time',
+    'duration':'Duration',
+    'stream_count':'# Streams',
+    'primary_artist':'# Unique Artists',
+    'song_title':'# Unique Songs'
+}
+
+def render_calendar(df, daily_rollup, year, quarter, df_fingerprint = None):
     """
     Render a scrobble heatmap with top artist, song, album, and most active day metrics.
     Args:
         df (pandas.DataFrame): processed scrobbles dataframe
+        daily_rollup (pandas.DataFrame): visualize.create_daily_rollup of df
         year (int): year to filter the heatmap by
         quarter (int): quarter to filter the heatmap by
+        df_fingerprint (str, default None): load.scrobbles_fingerprint of df, to 
+            reuse the heatmap from the figure cache
     Returns:
         None
     """
-    processed_scrobbles_filt, fig = visualize.create_scrobbles_heatmap(df, year, quarter)
-    cols = ['primary_artist', 'song_title', 'album_final', 'date']
+    fig = visualize.cached_figure(lambda: visualize.create_scrobbles_heatmap(daily_rollup, year, quarter),
+                                  df_fingerprint, 'heatmap', year = year, quarter = quarter)
+    in_quarter = (df['year'] == year) & df['month'].between(3 * quarter - 2, 3 * quarter)
+    processed_scrobbles_filt = df.loc[in_quarter, ['artist', 'primary_artist', 'song_title', 'album_final']]
+    cols = ['primary_artist', 'song_title', 'album_final']
     counts = {
         col:processed_scrobbles_filt[col].value_counts()
         for col in cols
@@ -24,7 +40,8 @@ def render_calendar(df, year, quarter):
         col:series.idxmax()
         for col, series in counts.items()
     }
-    top_date = top_cols['date']
+    quarter_days = daily_rollup.loc[(daily_rollup.year == year) & (daily_rollup.quarter == quarter)]
+    top_day = quarter_days.loc[quarter_days.streams.idxmax()]
     top_artist = top_cols['primary_artist']
     top_song = top_cols['song_title']
     top_album = top_cols['album_final']
@@ -35,8 +52,8 @@ def render_calendar(df, year, quarter):
     with col1:
         st.metric(
             label="🔥 Most Active Day",
-            value=str(pd.to_datetime(top_date).strftime("%-d %B")),
-            delta=f"{counts['date'][top_date]} streams",
+            value=top_day.date.strftime("%-d %B"),
+            delta=f"{top_day.streams} streams",
             delta_color = 'violet',
             delta_arrow = 'off'
         )
@@ -64,8 +81,8 @@ def render_calendar(df, year, quarter):
             width = 'content'
         )
 
-def create_example_insight(cluster, index, example_labels, 
-                           example_session_ids, processed_scrobbles):
+def create_example_insight(cluster, index, example_labels, example_session_ids, 
+                           processed_scrobbles, session_index = None, session_summaries = None):
     """
     Build an insight dict for a single example session within a cluster.
     Args:
@@ -74,13 +91,18 @@ def create_example_insight(cluster, index, example_labels,
         example_labels (dict): mapping of cluster ID to list of display labels
         example_session_ids (dict): mapping of cluster ID to list of session IDs
         processed_scrobbles (pandas.DataFrame): full scrobble-level dataframe
+        session_index (pandas.DataFrame, default None): sessions.create_session_index 
+            of processed_scrobbles
+        session_summaries (pandas.DataFrame, default None): clustering.create_session_summaries
+            of processed_scrobbles
     Returns:
         dict: dict with keys 'label' (str) and 'insights' (dict from session_insights)
     """
     ex = {}
     ex['label'] = example_labels[cluster][index]
     example_id = example_session_ids[cluster][index]
-    ex['insights'] = clustering.session_insights(processed_scrobbles, example_id)
+    ex['insights'] = clustering.session_insights(processed_scrobbles, example_id, 
+                                                 session_index, session_summaries)
     return ex 
 
 def render_cluster_tab(example_insights, ex_num):
@@ -131,7 +153,23 @@ def render_cluster_tab(example_insights, ex_num):
             hide_index = True
         )
     
-def cluster_example_tab(cluster, session_stats, processed_scrobbles):
+def cluster_example_tab(cluster, session_stats, processed_scrobbles, 
+                        session_index = None, session_summaries = None, neighbors_index = None):
+    """
+    Render a button that shows a random listening session of a cluster, and the 
+    sessions most like it if a neighbors index is given.
+    Args:
+        cluster (int): cluster ID to pick the session from
+        session_stats (pandas.DataFrame): session stats with a 'cluster' column
+        processed_scrobbles (pandas.DataFrame): full scrobble-level dataframe
+        session_index (pandas.DataFrame, default None): sessions.create_session_index 
+            of processed_scrobbles
+        session_summaries (pandas.DataFrame, default None): clustering.create_session_summaries
+            of processed_scrobbles
+        neighbors_index (dict, default None): clustering.create_neighbors_index of session_stats
+    Returns:
+        None
+    """
     session_ids = session_stats.loc[
         (session_stats.stream_count > 1) & 
         (session_stats.cluster == cluster)
@@ -139,7 +177,8 @@ def cluster_example_tab(cluster, session_stats, processed_scrobbles):
     choose_session_id = st.button(f"Generate random listening session for Cluster {cluster + 1}")
     if choose_session_id:
         example_id = np.random.choice(session_ids, 1)[0]
-        insights = clustering.session_insights(processed_scrobbles, example_id)  
+        insights = clustering.session_insights(processed_scrobbles, example_id, 
+                                              session_index, session_summaries)
         col1, col2, = st.columns([1, 1.5])
         with col1:
             if insights['duration'][0] != '0':
@@ -175,3 +214,8 @@ def cluster_example_tab(cluster, session_stats, processed_scrobbles):
                 ),
                 hide_index = True
             )
+        if neighbors_index is not None and session_summaries is not None:
+            similar_ids = clustering.similar_sessions(neighbors_index, example_id).session_id
+            st.markdown('**Sessions Like This One**')
+            st.dataframe(session_summaries.loc[similar_ids, list(SESSION_SUMMARY_COLUMNS)]
+                         .rename(columns = SESSION_SUMMARY_COLUMNS), hide_index = True)